@@ -1,118 +1,246 @@
 import sys # Added for stderr debug printing
+import asyncio
+import pickle
 import time
 import uuid
 import threading
 import hashlib # For hashing cell content
-from multiprocessing import Process, Queue, Manager
+import json
+import logging
+from base64 import b64encode
+from multiprocessing.connection import wait
 import queue # Explicit import for queue.Empty
-import cloudpickle # Import cloudpickle
 from IPython.core.magic import Magics, line_magic, cell_magic, magics_class
 from IPython.display import display, clear_output, HTML, publish_display_data as main_publish_display_data
 from IPython import get_ipython
 
-# Import the runner function
-from .background_runner import run_code_in_background
+from .background_runner import _format_error
+from .channel import OutputChannel
+from .serialization import SharedPayload
+from .worker import BackgroundWorker
+
+# Warnings users see are printed into the cell; records are for whoever configures logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Each idle worker holds a forked copy of the kernel's memory, so only a few are
+# kept warm (at most one per namespace), and none for longer than this many seconds
+MAX_IDLE_WORKERS = 4
+IDLE_WORKER_TIMEOUT = 600
+
+try:
+    import xxhash # Optional: fastest non-cryptographic hash for the cell identity key
+except ImportError:
+    xxhash = None
+
+
+def _cell_key(cell: str) -> str:
+    """Identity key of a cell's source, used to find a previous run of the same cell."""
+    data = cell.encode('utf-8')
+    if xxhash is not None:
+        return xxhash.xxh3_64_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+class _StatusScheduler:
+    """Rate limiter for the status line shown above a background cell's output.
+
+    Only the latest status HTML is kept. It is sent at most once per
+    ``interval`` and only when it differs from what is already displayed, so
+    a chatty cell costs one status update per interval, not one per message.
+    """
+
+    def __init__(self, display_id: str, interval: float):
+        self.display_id = display_id
+        self.interval = interval
+        self._pending = None
+        self._shown = None
+        self._last_emit = 0.0
+
+    def set(self, html: str):
+        self._pending = html
+
+    def tick(self):
+        """Send the pending status if the interval has elapsed since the last one."""
+        if time.monotonic() - self._last_emit >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Send the pending status now, if it changed."""
+        if self._pending is None or self._pending == self._shown:
+            return
+        self._last_emit = time.monotonic()
+        self._shown = self._pending
+        try:
+            display(HTML(self._pending), display_id=self.display_id, update=True)
+        except Exception as display_err:
+            # Log if status update fails, but don't crash listener
+            print(f"[Listener Warning] Failed to update status display: {display_err}", file=sys.stderr)
+
+def _send_to_cell(parent_header, name, text):
+    """Write ``text`` to the ``name`` stream of the cell ``parent_header`` belongs to, from any thread."""
+    ipython = get_ipython()
+    kernel = getattr(ipython, 'kernel', None)
+    if parent_header and kernel is not None and getattr(kernel, 'session', None) \
+            and getattr(kernel, 'iopub_socket', None):
+        kernel.session.send(kernel.iopub_socket, 'stream', {'name': name, 'text': text},
+                            parent=parent_header, ident=None)
+    else:
+        print(text, end='', file=sys.stderr if name == 'stderr' else sys.stdout)
+
+# Most messages handled per listener pass, so status updates keep coming under heavy output
+_MAX_BATCH = 1000
+
+
+def _get_batch(output_queue, timeout):
+    """Block for one message, then take whatever else is already waiting."""
+    if hasattr(output_queue, 'get_many'):
+        return output_queue.get_many(timeout=timeout, max_messages=_MAX_BATCH)
+    messages = [output_queue.get(timeout=timeout)] # Plain queue.Queue / multiprocessing.Queue
+    while len(messages) < _MAX_BATCH:
+        try:
+            messages.append(output_queue.get_nowait())
+        except queue.Empty:
+            break
+    return messages
+
+
+def _load_display(content):
+    """Rebuild a display payload, base64-encoding binary data as Jupyter expects."""
+    if isinstance(content, SharedPayload):
+        display_payload = content.load() # Large binary data, copied out of shared memory
+    elif isinstance(content, bytes):
+        display_payload = pickle.loads(content) # The publisher fell back to cloudpickle
+    else:
+        display_payload = content
+    data = display_payload.get('data', {})
+    for mime, value in data.items():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            data[mime] = b64encode(value).decode('ascii')
+    return data, display_payload.get('metadata', {})
+
 
 # Function executed by the listener thread
-def output_listener(output_queue: Queue, status_display_id: str, stop_event: threading.Event, parent_header):
+def output_listener(output_queue: OutputChannel, status_display_id: str, stop_event: threading.Event, parent_header):
     """Listens to the queue and displays output in the cell, associated with parent_header."""
     ipython = get_ipython()
     # Ensure kernel, session, and iopub_socket exist
     if not ipython or not hasattr(ipython, 'kernel') or not ipython.kernel \
        or not hasattr(ipython.kernel, 'iopub_socket') or not ipython.kernel.iopub_socket \
        or not hasattr(ipython.kernel, 'session') or not ipython.kernel.session:
-        print("[Listener Error] Could not get IPython kernel, session, or iopub_socket.", file=sys.stderr)
-        return # Cannot display output reliably
-
-    session = ipython.kernel.session
-    iopub_socket = ipython.kernel.iopub_socket # Get the actual socket
+        # Keep draining anyway: the channel is a pipe, so an abandoned reader would
+        # eventually block the background process on its next write.
+        session = iopub_socket = None
+        parent_header = None # Use the print/display fallback below
+    else:
+        session = ipython.kernel.session
+        iopub_socket = ipython.kernel.iopub_socket # Get the actual socket
 
     running_indicator = ["/", "-", "\\\\", "|"]
-    indicator_idx = 0
     start_time = time.time()
     update_interval = 0.5
-    last_update_time = 0
+    status = _StatusScheduler(status_display_id, update_interval)
     final_status = "Unknown"
     process_finished = False
 
+    # Stream content is always {"name": ..., "text": ...}. With the JSON packer
+    # the fixed part is encoded once here and the content is sent pre-packed.
+    stream_prefixes = None
+    # The parent header and metadata frames are the same for every message of
+    # this task, so whole stream messages are assembled from cached frames and
+    # only the header (fresh msg_id and date) is packed per message.
+    packed_parent = packed_metadata = None
+    if session is not None and getattr(session, 'packer', None) == 'json':
+        stream_prefixes = {name: f'{{"name": "{name}", "text": '.encode('utf-8') for name in ('stdout', 'stderr')}
+        if parent_header and hasattr(session, 'send_raw') and not getattr(session, 'adapt_version', None):
+            from jupyter_client.session import extract_header # Present whenever a kernel session is
+            packed_parent = session.pack(extract_header(parent_header))
+            packed_metadata = session.pack(dict(session.metadata))
+
+    def send_stream(name, text):
+        """Send one coalesced chunk of stdout/stderr text."""
+        if not parent_header:
+            # Fallback: print directly, output might not be isolated correctly
+            print(text, end='', file=sys.stderr if name == 'stderr' else sys.stdout)
+            return
+        if stream_prefixes is not None:
+            # Same encoding as jupyter_client's json_packer
+            stream_content = b''.join((stream_prefixes[name],
+                                       json.dumps(text, ensure_ascii=False).encode('utf-8', 'surrogateescape'), b'}'))
+        else:
+            stream_content = {'name': name, 'text': text}
+        if packed_parent is not None:
+            header = session.pack(session.msg_header('stream'))
+            session.send_raw(iopub_socket, [header, packed_parent, packed_metadata, stream_content])
+            return
+        session.send(iopub_socket, 'stream', stream_content, parent=parent_header, ident=None)
+
     while not stop_event.is_set():
         try:
             timeout = 0.05 if process_finished else 0.1
-            message = output_queue.get(timeout=timeout)
-            msg_type, task_id, content = message
-
-            # Ensure parent_header is valid before sending
-            if not parent_header:
-                # Fallback: Use display() which might not isolate output correctly
-                # This might happen in test environments without a kernel.
-                if msg_type == "stdout": print(content, end='')
-                elif msg_type == "stderr": print(content, file=sys.stderr, end='')
-                elif msg_type == "display_data":
-                     try:
-                         payload = cloudpickle.loads(content)
-                         display(payload.get('data',{}), raw=True) # Display raw data dict
-                     except Exception as e:
-                          print(f"[Display Error - No Header] {e}", file=sys.stderr)
-                continue # Skip status messages if no header
-
-            # Send messages using session.send with the iopub_socket
-            if msg_type == "stdout":
-                stream_content = {'name': 'stdout', 'text': content}
-                session.send(iopub_socket, 'stream', stream_content, parent=parent_header, ident=None)
-            elif msg_type == "stderr":
-                stream_content = {'name': 'stderr', 'text': content}
-                session.send(iopub_socket, 'stream', stream_content, parent=parent_header, ident=None)
-            elif msg_type == "display_data":
-                try:
-                    payload = cloudpickle.loads(content)
-                    data = payload.get('data', {})
-                    metadata = payload.get('metadata', {})
-                    display_content = {
-                        'data': data,
-                        'metadata': metadata,
-                        'transient': {}
-                    }
-                    session.send(iopub_socket, 'display_data', display_content, parent=parent_header, ident=None)
-                except Exception as e:
-                    err_text = f"[Display Error] {e}\n{traceback.format_exc()}"
-                    stream_content = {'name': 'stderr', 'text': err_text}
-                    # Send error back via stream message
-                    session.send(iopub_socket, 'stream', stream_content, parent=parent_header, ident=None)
-
-            elif msg_type == "status":
-                # Status updates handled locally via display(id=...), no change
-                if content == "running": last_update_time = time.time()
-                elif content == "completed": final_status = "completed"
-                elif content == "error": final_status = "error"
-                elif content == "finished_processing":
-                    process_finished = True
-                    if final_status == "Unknown": final_status = "completed"
-
-            last_update_time = time.time()
+            # Block for the first message, then drain everything already waiting
+            # so a burst of small writes turns into a single iopub message.
+            messages = _get_batch(output_queue, timeout)
+
+            # Consecutive chunks of the same stream are joined; a change of stream
+            # or any other message type flushes first so output order is preserved.
+            pending_name = None
+            pending_text = []
+            for msg_type, task_id, content in messages:
+                if msg_type in ("stdout", "stderr"):
+                    if msg_type != pending_name:
+                        if pending_text: send_stream(pending_name, ''.join(pending_text))
+                        pending_name, pending_text = msg_type, []
+                    pending_text.append(content)
+                    continue
+                if pending_text:
+                    send_stream(pending_name, ''.join(pending_text))
+                    pending_name, pending_text = None, []
+
+                if msg_type == "display_data":
+                    # Ensure parent_header is valid before sending
+                    if not parent_header:
+                        # Fallback: Use display() which might not isolate output correctly
+                        # This might happen in test environments without a kernel.
+                        try:
+                            data, _ = _load_display(content)
+                            display(data, raw=True) # Display raw data dict
+                        except Exception as e:
+                            print(f"[Display Error - No Header] {e}", file=sys.stderr)
+                        continue
+                    try:
+                        data, metadata = _load_display(content)
+                        display_content = {
+                            'data': data,
+                            'metadata': metadata,
+                            'transient': {}
+                        }
+                        session.send(iopub_socket, 'display_data', display_content, parent=parent_header, ident=None)
+                    except Exception as e:
+                        # Send error back via stream message
+                        send_stream('stderr', f"[Display Error] {e}\n{_format_error(e)}")
+
+                elif msg_type == "status":
+                    # Status updates handled locally via display(id=...), no change.
+                    # The runner ends every task with a single "completed"/"error".
+                    if content in ("completed", "error"):
+                        final_status = content
+                        process_finished = True
+                    elif content == "finished_processing":
+                        process_finished = True
+                        if final_status == "Unknown": final_status = "completed"
+            if pending_text:
+                send_stream(pending_name, ''.join(pending_text))
 
         except queue.Empty:
             # No message?
             if process_finished:
                 # If the process finished sending AND the queue is now empty, stop listener.
                 stop_event.set()
-            elif not stop_event.is_set():
-                # Update the running indicator only if the process hasn't finished
-                current_time = time.time()
-                if current_time - last_update_time >= update_interval:
-                    elapsed_time = int(current_time - start_time)
-                    indicator = running_indicator[indicator_idx % len(running_indicator)]
-                    # Updated format: Running (Xs) Indicator
-                    status_html = f"<div id='{status_display_id}' style='margin-bottom: 5px;'><i>Running ({elapsed_time}s) {indicator}</i></div>"
-                    # Update status display - this still uses display() with id, which should be okay
-                    # as it targets a specific element ID.
-                    try:
-                         display(HTML(status_html), display_id=status_display_id, update=True)
-                    except Exception as display_err:
-                         # Log if status update fails, but don't crash listener
-                         print(f"[Listener Warning] Failed to update status display: {display_err}", file=sys.stderr)
-                    last_update_time = current_time
-                    indicator_idx += 1
-            continue # Go back to checking the queue or timeout
+                continue
+        except EOFError:
+            # Every writer is gone: the process exited without signalling completion
+            if final_status == "Unknown": final_status = "terminated"
+            stop_event.set()
         except Exception as e:
             # Log listener errors (shouldn't happen often)
             print(f"[Listener Error] {e}", file=sys.stderr)
@@ -120,23 +248,150 @@ def output_listener(output_queue: Queue, status_display_id: str, stop_event: thr
             stop_event.set()
             break
 
+        # Update the running indicator only if the process hasn't finished. The
+        # scheduler drops all but one update per interval, however much output arrives.
+        if not process_finished and not stop_event.is_set():
+            elapsed = time.time() - start_time
+            indicator = running_indicator[int(elapsed / update_interval) % len(running_indicator)]
+            # Updated format: Running (Xs) Indicator
+            status.set(f"<div id='{status_display_id}' style='margin-bottom: 5px;'><i>Running ({int(elapsed)}s) {indicator}</i></div>")
+            status.tick()
+
     # --- Loop finished ---
     elapsed_time = int(time.time() - start_time)
     # Capitalize status for display
     display_status = final_status.capitalize()
-    final_html = f"<div id='{status_display_id}' style='margin-bottom: 5px;'><i>Finished ({display_status}) - {elapsed_time}s</i></div>"
     # Final display update, ensure it happens even if loop exited quickly
-    try:
-        display(HTML(final_html), display_id=status_display_id, update=True)
-    except Exception as display_err:
-         print(f"[Listener Error] Could not display final status: {display_err}", file=sys.stderr)
+    status.set(f"<div id='{status_display_id}' style='margin-bottom: 5px;'><i>Finished ({display_status}) - {elapsed_time}s</i></div>")
+    status.flush()
+
+
+class TaskRecord:
+    """Bookkeeping for one ``%%background`` run."""
+    __slots__ = ('worker', 'listener', 'queue', 'stop_event', 'status_display_id',
+                 'cell_hash', 'namespace', 'transfer_complete', 'stopped')
+
+    def __init__(self, worker, listener, stop_event, status_display_id, cell_hash, namespace, transfer_complete):
+        self.worker = worker
+        self.listener = listener
+        self.queue = worker.output_queue
+        self.stop_event = stop_event
+        self.status_display_id = status_display_id
+        self.cell_hash = cell_hash # For the O(1) reverse lookup in _stop_task
+        self.namespace = namespace
+        self.transfer_complete = transfer_complete # Set once the variables are transferred, or the task stopped
+        self.stopped = False # Stopped before its variables were transferred
+
+    @property
+    def process(self):
+        return self.worker.process if self.worker is not None else None
+
+    def release(self):
+        """Forget the worker once the task is over; handles kept in ``Out`` would pin its pipes."""
+        self.worker = self.queue = None
+
+
+class BackgroundHandle:
+    """Handle to a ``%%background`` run, returned by the magic.
+
+    The cell returns immediately. Grab the handle in a later cell with
+    ``task = _`` and then:
+
+    * ``task.wait(timeout=None)`` blocks until the variables are transferred,
+    * ``task['res']`` waits, then reads ``res`` from the cell's namespace, and
+      ``task.get('res', default, timeout=...)`` does the same with a time limit,
+    * ``task.res`` reads ``res`` without waiting; while the task runs it raises
+      ``AttributeError``, so completers probing the handle never block,
+    * ``await task`` waits without blocking the event loop.
+
+    The handle shows nothing as the ``%%background`` cell's result; elsewhere
+    (a bare ``task``) it shows whether the task is running, done or stopped.
+    Handles kept in the kernel's globals are never sent to background cells.
+
+    Variables named like the handle's own attributes (``done``, ``wait``,
+    ``task_id``...) are only reachable as ``task['done']``.
+
+    If the task is stopped (superseded by a re-run, or the extension is
+    unloaded) waiting returns at once, and reading a variable or awaiting the
+    handle raises ``RuntimeError`` rather than returning stale values.
+    """
+
+    def __init__(self, task_id, record: TaskRecord, get_namespace, execution_count=None):
+        self.task_id = task_id
+        self._record = record
+        self._get_namespace = get_namespace
+        self._execution_count = execution_count # Of the %%background cell itself
+
+    def done(self):
+        return self._record.transfer_complete.is_set()
+
+    def stopped(self):
+        return self._record.stopped
+
+    def wait(self, timeout=None):
+        """Block until the task's variables are transferred or it is stopped; returns False on timeout."""
+        return self._record.transfer_complete.wait(timeout)
+
+    def _check_not_stopped(self):
+        if self._record.stopped:
+            raise RuntimeError(f"background task {self.task_id} was stopped")
+
+    def get(self, name, default=None, timeout=None):
+        """Wait up to ``timeout`` for the task, then read ``name``, or ``default`` if it was not returned.
+
+        Raises ``TimeoutError`` if the task is still running by then.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"background task {self.task_id} is still running")
+        self._check_not_stopped()
+        return self._get_namespace().get(name, default)
+
+    def __getitem__(self, name):
+        self.wait()
+        self._check_not_stopped()
+        try:
+            return self._get_namespace()[name]
+        except KeyError:
+            raise KeyError(f"background task {self.task_id} did not return '{name}'") from None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # Never waits: hasattr() from completers and variable inspectors would hang the kernel
+        if not self.done():
+            raise AttributeError(f"background task {self.task_id} is still running; "
+                                 f"use task[{name!r}] to wait for '{name}'")
+        self._check_not_stopped()
+        try:
+            return self._get_namespace()[name]
+        except KeyError:
+            raise AttributeError(f"background task {self.task_id} did not return '{name}'") from None
+
+    async def _wait_async(self):
+        finished = await asyncio.get_running_loop().run_in_executor(None, self.wait)
+        self._check_not_stopped()
+        return finished
+
+    def __await__(self):
+        return self._wait_async().__await__()
+
+    def _ipython_display_(self):
+        # As the result of the %%background cell, the output area belongs to the task
+        ipython = get_ipython()
+        if ipython is not None and ipython.execution_count == self._execution_count:
+            return
+        raise NotImplementedError # Anywhere else (a bare `task`), shown by its repr
+
+    def __repr__(self):
+        state = 'stopped' if self.stopped() else 'done' if self.done() else 'running'
+        return f"<BackgroundHandle {self.task_id} ({state})>"
 
 
 @magics_class
 class BackgroundMagics(Magics):
     def __init__(self, shell):
         super(BackgroundMagics, self).__init__(shell)
-        # Store task info: {task_id: {'process': Process, 'listener': Thread, ...}}
+        # Store task info: {task_id: TaskRecord}
         self._background_tasks = {}
         # Map cell content hash to running task_id
         self._cell_hash_to_task_id = {}
@@ -145,8 +400,11 @@ class BackgroundMagics(Magics):
         shell._background_magic_instance = self
         # Dictionary to store namespaces from background processes
         self._namespaces = {}
-        # Manager for shared dictionaries
-        self._manager = Manager()
+        # Warm, idle worker processes: namespace (None for the global one) ->
+        # (worker, time it went idle), longest idle first
+        self._idle_workers = {}
+        self._workers_lock = threading.Lock()
+        self._reap_timer = None # Shuts down workers idle for too long
 
     # Ensure cleanup happens when the Magics object is deleted (e.g., kernel restart)
     def __del__(self):
@@ -157,28 +415,27 @@ class BackgroundMagics(Magics):
         """Stops and cleans up a specific background task by its ID."""
         task_info = self._background_tasks.pop(task_id, None)
         if not task_info: return
+        # Its transfer thread gives up once the record is gone, so the handle is released here
+        if not task_info.transfer_complete.is_set():
+            task_info.stopped = True
 
-        # Find and remove the corresponding cell hash entry
-        cell_hash_to_remove = None
-        for cell_hash, running_task_id in self._cell_hash_to_task_id.items():
-            if running_task_id == task_id:
-                cell_hash_to_remove = cell_hash
-                break
-        if cell_hash_to_remove:
-            del self._cell_hash_to_task_id[cell_hash_to_remove]
+        # Remove the corresponding cell hash entry, unless a newer run of the cell owns it
+        if self._cell_hash_to_task_id.get(task_info.cell_hash) == task_id:
+            del self._cell_hash_to_task_id[task_info.cell_hash]
 
         # print(f"Stopping task {task_id}...") # Can be noisy
-        process = task_info['process']
-        listener = task_info['listener']
-        stop_event = task_info['stop_event']
-        status_display_id = task_info['status_display_id']
+        worker = task_info.worker
+        if worker is None:
+            return # Finished; its worker went back to the pool
+        listener = task_info.listener
+        stop_event = task_info.stop_event
+        status_display_id = task_info.status_display_id
 
         try:
             if listener.is_alive(): stop_event.set()
-            if process.is_alive():
-                process.terminate()
-                process.join(timeout=0.5)
-                if process.is_alive(): process.kill(); process.join(timeout=0.2)
+            # The worker is busy with this task, so it cannot be reused
+            # stop() also drops the figures and result it queued and nobody will show
+            worker.stop()
             if listener.is_alive(): listener.join(timeout=0.5)
 
             # Update status display to indicate it was stopped
@@ -189,9 +446,71 @@ class BackgroundMagics(Magics):
                 pass # Ignore display errors during potentially messy cleanup
         except Exception as e:
             print(f"    Error stopping task {task_id}: {e}", file=sys.stderr)
+        finally:
+            task_info.release()
+            task_info.transfer_complete.set()
+
+    def _acquire_worker(self, namespace, context):
+        """Take the idle worker for ``namespace``, or start a new one (forked with ``context``) if it is busy."""
+        with self._workers_lock:
+            worker, _ = self._idle_workers.pop(namespace, (None, None))
+        if worker is not None and worker.is_alive():
+            return worker
+        return BackgroundWorker(namespace, context)
+
+    def _release_worker(self, worker):
+        """Keep ``worker`` for the next cell of its namespace, unless one is already waiting.
+
+        Past ``MAX_IDLE_WORKERS``, the worker idle the longest is shut down to make room.
+        """
+        if not worker.is_alive():
+            return
+        retired = [worker]
+        with self._workers_lock:
+            if worker.namespace not in self._idle_workers:
+                self._idle_workers[worker.namespace] = (worker, time.monotonic())
+                retired = []
+                while len(self._idle_workers) > MAX_IDLE_WORKERS:
+                    retired.append(self._idle_workers.pop(next(iter(self._idle_workers)))[0])
+                self._schedule_reap()
+        for worker in retired:
+            worker.shutdown()
+
+    def _schedule_reap(self):
+        """Arm the timer for the longest idle worker's timeout, unless it is armed (lock held)."""
+        if self._reap_timer is not None or not self._idle_workers:
+            return
+        _, idle_since = next(iter(self._idle_workers.values()))
+        delay = max(0.0, idle_since + IDLE_WORKER_TIMEOUT - time.monotonic())
+        self._reap_timer = threading.Timer(delay, self._reap_idle_workers)
+        self._reap_timer.daemon = True
+        self._reap_timer.start()
+
+    def _reap_idle_workers(self):
+        """Shut down the workers idle for more than ``IDLE_WORKER_TIMEOUT`` seconds."""
+        expired = []
+        with self._workers_lock:
+            self._reap_timer = None
+            deadline = time.monotonic() - IDLE_WORKER_TIMEOUT
+            for namespace, (worker, idle_since) in list(self._idle_workers.items()):
+                if idle_since <= deadline:
+                    expired.append(worker)
+                    del self._idle_workers[namespace]
+            self._schedule_reap()
+        for worker in expired:
+            worker.shutdown()
 
     def _unload_tasks(self):
         """Helper method to stop all tasks, used by __del__ and unload_ipython_extension."""
+        if hasattr(self, '_idle_workers'):
+            with self._workers_lock:
+                idle_workers = [worker for worker, _ in self._idle_workers.values()]
+                self._idle_workers.clear()
+                if self._reap_timer is not None:
+                    self._reap_timer.cancel()
+                    self._reap_timer = None
+            for worker in idle_workers:
+                worker.shutdown()
         if not hasattr(self, '_background_tasks') or not self._background_tasks:
              return
         print(f"Attempting to stop {len(self._background_tasks)} background task(s)...")
@@ -219,13 +538,12 @@ class BackgroundMagics(Magics):
         # If parent_header is still None, output might not be perfectly isolated in all clients.
 
         # --- Stop previous instance of this cell if running ---
-        cell_content_hash = hashlib.sha1(cell.encode('utf-8')).hexdigest()
+        cell_content_hash = _cell_key(cell)
         previous_task_id = self._cell_hash_to_task_id.get(cell_content_hash)
 
         if previous_task_id and previous_task_id in self._background_tasks:
-            # Check if the process associated with that task ID is actually still running
-            previous_process = self._background_tasks[previous_task_id].get('process')
-            if previous_process and previous_process.is_alive():
+            # Workers outlive their tasks, so ask the task itself whether it is still running
+            if not self._background_tasks[previous_task_id].transfer_complete.is_set():
                 print(f"Stopping previous background run for this cell (Task ID: {previous_task_id[:8]}...).", file=sys.stderr)
                 self._stop_task(previous_task_id)
                 time.sleep(0.1) # Brief pause to allow cleanup
@@ -240,7 +558,6 @@ class BackgroundMagics(Magics):
         base_id = f"bg_task_{self._task_counter}"
         task_id = f"{base_id}_{uuid.uuid4().hex[:8]}"
         status_display_id = f"status_{task_id}"
-        output_queue = Queue()
         stop_event = threading.Event()
 
         # --- Capture and serialize global context ---
@@ -249,7 +566,7 @@ class BackgroundMagics(Magics):
         skipped_keys = []
         # Common IPython variables to exclude from serialization
         ipython_builtins_to_skip = {
-            'In', 'Out', 'get_ipython', 'exit', 'quit',
+            'In', 'Out', 'get_ipython', 'exit', 'quit', 'open',
             '_', '__', '___', '_i', '_ii', '_iii', '_ih', '_oh', '_dh'
             # Add others if necessary
         }
@@ -262,32 +579,17 @@ class BackgroundMagics(Magics):
                     serializable_ns[k] = v
             print(f"[Info] Using variables from namespace '{namespace}'", file=sys.stderr)
 
-        # Add global variables
+        # Add global variables, filtering on the key only; values are checked when the worker pickles them.
+        # Handles of earlier runs (task = _) hold the shell and are of no use in a worker.
         for k, v in user_ns.items():
-            # Check if key should be skipped *first*
-            if (k.startswith('_') and k not in ('_', '__', '___')) or k in ipython_builtins_to_skip:
+            if (k.startswith('_') and k not in ('_', '__', '___')) or k in ipython_builtins_to_skip \
+                    or isinstance(v, BackgroundHandle):
                  skipped_keys.append(k)
                  continue
+            serializable_ns[k] = v
 
-            # If not skipped, *then* try to pickle
-            try:
-                cloudpickle.dumps(v)
-                serializable_ns[k] = v
-            except Exception as pickle_err:
-                # If pickling fails for a variable we didn't intend to skip, warn and skip it.
-                skipped_keys.append(k)
-                print(f"[Warning] Skipping non-serializable global variable '{k}' (type: {type(v).__name__}). Error: {pickle_err}", file=sys.stderr)
-                # No need to continue here, the loop naturally proceeds
-
-        # Now, serialize the dictionary of successfully pickled items
-        try:
-            serialized_context = cloudpickle.dumps(serializable_ns)
-        except Exception as e:
-            print(f"[Error] Failed to serialize the collected global context: {e}", file=sys.stderr)
-            serialized_context = None # Signal to runner that context failed
-
-        # Create a manager dict to receive variables from the background process
-        result_dict = self._manager.dict()
+        worker = self._acquire_worker(namespace, serializable_ns)
+        output_queue = worker.output_queue
 
         initial_status_html = f"<div id='{status_display_id}' style='margin-bottom: 5px;'><i>Starting [{base_id}]...</i></div>"
         display(HTML(initial_status_html), display_id=status_display_id)
@@ -300,27 +602,19 @@ class BackgroundMagics(Magics):
         )
         listener.start()
 
-        process = Process(
-            target=run_code_in_background,
-            # Pass serialized context to the runner function
-            args=(cell, output_queue, task_id, serialized_context, result_dict),
-            daemon=True
-        )
-        process.start()
+        # Returns straight away: the serializer thread pickles the globals and sends
+        # the ones that changed since the worker's last run
+        submitted = worker.submit(cell, task_id, serializable_ns)
 
         # Store task info and update cell hash mapping
-        self._background_tasks[task_id] = {
-            'process': process,
-            'listener': listener,
-            'queue': output_queue,
-            'stop_event': stop_event,
-            'status_display_id': status_display_id,
-            'cell_hash': cell_content_hash, # Store hash for potential reverse lookup
-            'namespace': namespace,
-            'result_dict': result_dict,
-            'transfer_complete': threading.Event()  # Add event for tracking transfer completion
-        }
+        transfer_complete = threading.Event()
+        record = TaskRecord(
+            worker, listener, stop_event, status_display_id, cell_content_hash, namespace, transfer_complete)
+        self._background_tasks[task_id] = record
         self._cell_hash_to_task_id[cell_content_hash] = task_id # Map hash to new task ID
+        # Only once the record exists: a send that already failed runs the callback right here
+        submitted.add_done_callback(
+            lambda future: self._check_submitted(task_id, record, parent_header, future))
         
         # Start a thread to handle the transfer of variables after the process completes
         var_transfer_thread = threading.Thread(
@@ -330,56 +624,82 @@ class BackgroundMagics(Magics):
         )
         var_transfer_thread.start()
         
-        # Block briefly to ensure short-running cells have time to transfer variables
-        # This helps with cells that finish very quickly
-        time.sleep(0.2)
-        
-        # Check if the 'res' variable is critical for this cell
-        needs_res = 'res' in cell
-        if needs_res:
-            # Wait up to 5 seconds for variable transfer to complete if it has 'res'
-            task_info = self._background_tasks.get(task_id)
-            if task_info and 'transfer_complete' in task_info:
-                task_info['transfer_complete'].wait(5.0)
-                
-            # Log warning if still waiting
-            if task_info and 'transfer_complete' in task_info and not task_info['transfer_complete'].is_set():
-                print(f"[Warning] Variable transfer may still be in progress. 'res' variable may not be available immediately.", file=sys.stderr)
+        # Return at once; the handle lets later cells wait on the transfer explicitly
+        if namespace:
+            get_namespace = lambda: self._namespaces.get(namespace, {})
+        else:
+            get_namespace = lambda: self.shell.user_ns
+        return BackgroundHandle(task_id, record, get_namespace, self.shell.execution_count)
+
+    def _check_submitted(self, task_id, task_info, parent_header, future):
+        """Stop a task whose cell could not be sent to its worker, which would otherwise wait forever."""
+        error = future.exception()
+        worker = task_info.worker
+        if error is None or worker is None:
+            return
+        task_info.stopped = True
+        _send_to_cell(parent_header, 'stderr',
+                      f"[Error] Failed to send task {task_id} to its background process: {error}\n{_format_error(error)}")
+        # The listener sees the channel close and the transfer thread the process exit
+        worker.stop()
 
     def _handle_variable_transfer(self, task_id):
-        """Wait for process to complete and transfer variables."""
+        """Wait for the task to complete, transfer its variables and release its worker."""
         if task_id not in self._background_tasks:
             return
             
         task_info = self._background_tasks[task_id]
-        process = task_info['process']
-        namespace = task_info['namespace']
-        result_dict = task_info['result_dict']
-        transfer_complete_event = task_info.get('transfer_complete')
-        
-        # Wait for process to complete with timeout
-        max_wait = 120  # Maximum wait time in seconds - increased for long-running tasks
-        start_time = time.time()
-        
-        # Check periodically for variables while the process is running
-        while process.is_alive() and time.time() - start_time < max_wait:
-            # Check if variables are already available even while process is still running
-            if '__transfer_complete__' in result_dict:
-                break
-            time.sleep(0.5)  # Increased sleep time to reduce CPU usage
-        
-        # Wait a short time after the process completes to ensure variable transfer is done
-        if not process.is_alive():
-            time.sleep(0.5)
-        
-        # Get variables from result_dict (excluding special keys)
-        transferred_vars = {k: v for k, v in result_dict.items() 
-                           if not k.startswith('__') and k != '__transfer_complete__'}
+        worker = task_info.worker
+        transfer_complete_event = task_info.transfer_complete
+        if worker is None:
+            return # Already stopped and released by _stop_task
+
+        # Block until the worker reports its results are written, or exits without
+        # doing so (crashed or stopped). No polling, and no upper bound on run time.
+        try:
+            wait(worker.wait_handle())
+        except (OSError, ValueError):
+            pass # Its pipes were closed by _stop_task
+        if task_id not in self._background_tasks:
+            worker.discard_result() # Stopped; _stop_task disposes of the worker
+            return
+        try:
+            # Always consume the message: the pipe is reused by the worker's next task
+            try:
+                result_message = worker.result_conn.recv_bytes() if worker.result_conn.poll() else b''
+            except (OSError, EOFError):
+                return # Stopped after the check above; _stop_task closed the pipe
+            self._transfer_variables(task_id, task_info, result_message)
+        finally:
+            # The listener drains the task's last messages from the shared channel;
+            # the worker can only take another cell once it is done.
+            listener = task_info.listener
+            listener.join(timeout=5.0)
+            # Before the worker can be pooled, so _stop_task never stops it there
+            task_info.release()
+            if listener.is_alive():
+                logger.warning("Output of background task %s was still being shown after 5s; "
+                               "the rest is discarded as its worker shuts down", task_id)
+                worker.shutdown()
+            else:
+                self._release_worker(worker)
+            # Only now, so a cell run right after task.wait() gets the warm worker
+            transfer_complete_event.set()
+
+    def _transfer_variables(self, task_id, task_info, result_message):
+        """Copy the variables a finished task returned into its namespace."""
+        namespace = task_info.namespace
+
+        # All returned variables arrive as one pickled SharedPayload holding a dict
+        transferred_vars = {}
+        if result_message:
+            try:
+                transferred_vars = pickle.loads(result_message).load()
+            except Exception as e:
+                print(f"[Warning] Failed to load returned variables: {e}", file=sys.stderr)
         
         if not transferred_vars:
             print(f"[Warning] No variables returned from background task {task_id[:8]}", file=sys.stderr)
-            if transfer_complete_event:
-                transfer_complete_event.set()  # Mark as complete even if no variables
             return
             
         # If namespace is specified, store variables in that namespace
@@ -398,10 +718,6 @@ class BackgroundMagics(Magics):
             if var_names:
                 print(f"[Info] Variables from background task updated in global namespace", file=sys.stderr)
                 print(f"[Debug] Transferred variables: {', '.join(var_names)}", file=sys.stderr)
-            
-            # Signal that transfer is complete
-            if transfer_complete_event:
-                transfer_complete_event.set()
 
 
 def load_ipython_extension(ipython):
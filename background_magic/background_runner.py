@@ -1,49 +1,147 @@
 """Module to handle running code in a background process."""
 
+import ast
+import builtins
 import sys
 import os
 import io
-import uuid
+import threading
 import traceback
-from multiprocessing import Process, Queue, Manager
-from io import StringIO
+import types
 import contextlib
+import functools
+import importlib.abc
+import pickle
 import cloudpickle
 from base64 import b64encode
 # Only import basic IPython display functions needed globally
-from IPython import get_ipython
-from IPython.display import display as ipy_display, publish_display_data as ipython_publish_display_data, HTML, Markdown, IFrame
+from IPython.display import HTML, Markdown, IFrame
+
+from .channel import OutputChannel
+from .serialization import (SHARED_MEMORY_SUPPORTED, SHARED_MEMORY_THRESHOLD, loads,
+                            namespace_to_shared, never_pickles, to_shared)
+
+# Buffered stream text is sent at least this often...
+STREAM_FLUSH_INTERVAL = 0.05
+# ...or as soon as this much has accumulated (well below the pipe's capacity)
+STREAM_BUFFER_SIZE = 8 * 1024
+# ...or when a line ends and at least this much is waiting
+STREAM_LINE_FLUSH_SIZE = 1024
+# Innermost frames kept when reporting display/plotting errors
+ERROR_TRACEBACK_LIMIT = 20
+
+
+def _format_error(e: BaseException) -> str:
+    """Traceback of ``e`` (being handled), trimmed to its innermost frames.
+
+    Errors raised deep inside matplotlib/plotly call trees produce long
+    tracebacks, and only the frames nearest the failure are of any use.
+    """
+    return ''.join(traceback.TracebackException.from_exception(e, limit=-ERROR_TRACEBACK_LIMIT).format())
 
 # Custom stream wrapper to write to the queue
-class QueueStream(StringIO):
-    def __init__(self, queue: Queue, task_id: str, stream_type: str):
+class QueueStream(io.TextIOBase):
+    """stdout/stderr replacement that batches writes into channel messages.
+
+    ``print`` alone makes two writes. Sending each one would cost a frame
+    and a syscall, so text is buffered until ``flush()``, which the
+    ``StreamFlusher`` thread calls every ``STREAM_FLUSH_INTERVAL``. Complete
+    lines are sent early once a sizeable chunk of them is waiting.
+    """
+
+    def __init__(self, queue: OutputChannel, task_id: str, stream_type: str):
         self.queue = queue
         self.task_id = task_id
         self.stream_type = stream_type # 'stdout' or 'stderr'
+        self.buffered = True
+        self._pending = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
 
     def write(self, buf):
-        self.queue.put((self.stream_type, self.task_id, buf))
+        if not buf:
+            return 0
+        with self._lock:
+            self._pending.append(buf)
+            self._pending_size += len(buf)
+            send_now = (not self.buffered or self._pending_size >= STREAM_BUFFER_SIZE
+                        or (self._pending_size >= STREAM_LINE_FLUSH_SIZE and '\n' in buf))
+        if send_now:
+            self.flush()
+        return len(buf)
 
     def flush(self):
-        # Optionally implement flush if needed, though often not required for queues
-        pass
+        with self._lock:
+            if not self._pending:
+                return
+            text = ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            # Sent under the lock so concurrent flushes keep the text in order
+            self.queue.put((self.stream_type, self.task_id, text))
+
+class StreamFlusher(threading.Thread):
+    """Flushes ``QueueStream``s periodically while a cell runs, like ipykernel's OutStream."""
+
+    def __init__(self, *streams):
+        super().__init__(daemon=True)
+        self.streams = streams
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(STREAM_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+    def stop(self):
+        """Stop the thread and flush; later writes (from stray user threads) are sent immediately."""
+        self._stop_event.set()
+        for stream in self.streams:
+            stream.buffered = False
+        self.flush()
 
 # Custom display publisher that sends data over the queue
 class QueueDisplayPublisher:
-    def __init__(self, queue: Queue, task_id: str):
+    def __init__(self, queue: OutputChannel, task_id: str, flusher: StreamFlusher | None = None):
         self.queue = queue
         self.task_id = task_id
+        self.flusher = flusher
 
     def publish(self, data, metadata=None, **kwargs):
         if metadata is None:
             metadata = {}
-        # Serialize and send display data
+        if self.flusher is not None:
+            self.flusher.flush() # Text printed before the display must show up before it
+        # Binary outputs (PNG...) go out-of-band, sparing a copy into the pickle;
+        # the listener base64-encodes them for the frontend.
+        large_binary = False
+        binary_data = {}
+        for mime, value in data.items():
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                large_binary = large_binary or memoryview(value).nbytes >= SHARED_MEMORY_THRESHOLD
+                value = pickle.PickleBuffer(value)
+            binary_data[mime] = value
+        display_payload = {'data': binary_data, 'metadata': metadata}
         try:
-            payload = cloudpickle.dumps({'data': data, 'metadata': metadata})
-            self.queue.put(('display_data', self.task_id, payload))
+            if large_binary and SHARED_MEMORY_SUPPORTED:
+                # Big figures skip the pipe: only the segment names are sent
+                self.queue.put(('display_data', self.task_id, to_shared(display_payload)))
+                return
+            try:
+                # The channel pickles the dict itself, so this is the only serialization pass
+                self.queue.put(('display_data', self.task_id, display_payload))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # Something only cloudpickle handles (e.g. a notebook-defined object in metadata)
+                self.queue.put(('display_data', self.task_id, cloudpickle.dumps(display_payload)))
         except Exception as e:
             # Send serialization error back as stderr
-            tb_str = f"Error serializing display data: {e}\n{traceback.format_exc()}"
+            tb_str = f"Error serializing display data: {e}\n{_format_error(e)}"
             self.queue.put(("stderr", self.task_id, tb_str))
 
     # Implement other methods if needed by display logic (often not necessary)
@@ -54,89 +152,488 @@ class QueueDisplayPublisher:
     #     self.publish(data, metadata=metadata)
 
 def is_module_or_unpicklable(obj):
-    """Check if an object is a module or otherwise likely to be unpicklable."""
-    # Check if it's a module
-    if isinstance(obj, type(sys)):
-        return True
-    
-    # Check if it has module-like attributes
-    if hasattr(obj, '__name__') and hasattr(obj, '__spec__') and hasattr(obj, '__package__'):
-        return True
-    
-    # Check if it's a function that refers to modules
-    if callable(obj) and hasattr(obj, '__module__') and obj.__module__ in sys.modules:
-        # Functions defined in modules should be fine with cloudpickle, but
-        # check if it contains references to sys or other known problematic modules
-        return False
-        
-    return False
+    """Check if an object is a module; those are never sent back, the kernel has its own."""
+    # Lazy-loading proxies and other module stand-ins subclass ModuleType too
+    return isinstance(obj, types.ModuleType)
 
-def run_code_in_background(code_str: str, output_queue: Queue, task_id: str, serialized_context: bytes | None, result_dict=None):
-    """Executes code, capturing stdout/stderr and display outputs."""
-    # --- Initialize execution context ---
-    exec_globals = globals().copy()
-    if serialized_context:
+@functools.lru_cache(maxsize=None)
+def _display_formatter():
+    """IPython's MIME formatters, built once per process without needing a shell.
+
+    ``_ipython_display_`` hooks are not called: they display through the
+    kernel's shell and sockets, which a forked worker inherits but must not use.
+    """
+    from IPython.core.formatters import DisplayFormatter
+    formatter = DisplayFormatter()
+    formatter.ipython_display_formatter.enabled = False
+    return formatter
+
+
+class _ActiveTask:
+    """Output sinks of the cell currently running in this process.
+
+    The plotting hooks are installed once per process by ``_init_worker``,
+    while the publisher and streams are created for every cell.
+    """
+    display_pub = None
+    display = None
+    stdout = None
+    stderr = None
+
+
+_base_globals = None # Set by _init_worker: the globals every cell starts from
+_worker_notes = [] # (stream name, text) printed by _init_worker, shown with the next cell
+
+
+# Figures are rendered into one buffer per worker. It grows to the largest PNG
+# seen and is never truncated (which would free it); bytes past the current
+# image are ignored.
+_png_buffer = io.BytesIO()
+_png_buffer_lock = threading.Lock()
+
+
+def _patched_show(*args, **kwargs):
+    """``plt.show()`` replacement: publish each open figure as a PNG."""
+    import matplotlib
+    import matplotlib.pyplot as plt
+    for num, figmanager in enumerate(matplotlib._pylab_helpers.Gcf.get_all_fig_managers()):
+        fig = figmanager.canvas.figure
+
+        with _png_buffer_lock:
+            # Render into the shared buffer, overwriting from the start. No
+            # bbox_inches='tight': it costs a second layout pass; set
+            # rcParams['savefig.bbox'] to opt in.
+            _png_buffer.seek(0)
+            fig.savefig(_png_buffer, format='png')
+            size = _png_buffer.tell()
+
+            # Send the raw PNG to the frontend via our custom display publisher;
+            # it is base64-encoded by the listener, not here. The view avoids
+            # copying the image out of the buffer; publish is done with it on return.
+            with _png_buffer.getbuffer() as view, view[:size] as png:
+                _ActiveTask.display_pub.publish({'image/png': png, 'text/plain': repr(fig)})
+        print("[Debug] Matplotlib figure displayed", file=_ActiveTask.stdout)
+
+        # Also support other formats like SVG if needed
+        # Implement additional formats here if needed
+
+    # Close every figure to avoid double displaying (clf() would create a fresh one first)
+    plt.close('all')
+
+    return None
+
+
+def _display_plotly_figure(fig, include_interactive=False, filename=None):
+    """Show a Plotly figure as a static PNG.
+
+    Writing the interactive HTML is a multi-megabyte dump to disk, so it is
+    only done with ``include_interactive=True`` (or when no PNG can be made),
+    and a download link is shown next to the preview.
+    """
+    stdout_stream, stderr_stream = _ActiveTask.stdout, _ActiveTask.stderr
+    try:
+        print(f"[Debug] Display called for figure type: {type(fig)}", file=stdout_stream)
+
+        # Step 1: Generate a static PNG image
         try:
-            deserialized_ns = cloudpickle.loads(serialized_context)
-            exec_globals.update(deserialized_ns)
-        except Exception as e:
-            tb_str = f"Error deserializing context: {e}\n{traceback.format_exc()}"
-            output_queue.put(("stderr", task_id, tb_str))
-            output_queue.put(("status", task_id, "error"))
-            output_queue.put(("status", task_id, "finished_processing"))
+            _start_kaleido()
+            img_bytes = fig.to_image(format="png", scale=2, engine="kaleido")
+        except Exception as img_err:
+            print(f"[Warning] Static image generation failed: {img_err}", file=stderr_stream)
+            img_bytes = None
+
+        if img_bytes is not None and not include_interactive:
+            # Raw PNG; the listener base64-encodes it for the frontend
+            _ActiveTask.display_pub.publish({'image/png': img_bytes, 'text/plain': repr(fig)})
+            print("[Debug] Static image displayed", file=stdout_stream)
+            return
+
+        # Step 2: Save the figure to an HTML file
+        html_filename = filename or f"plotly_figure_{os.urandom(4).hex()}.html"
+        fig.write_html(html_filename, include_plotlyjs='cdn', full_html=True)
+        print(f"[Debug] Plotly figure saved to {html_filename}", file=stdout_stream)
+
+        if img_bytes is not None:
+            img_b64 = b64encode(img_bytes).decode('utf-8')
+
+            # Step 3: Create HTML with static image and download link
+            download_html = f'''
+            <div style="margin: 10px 0;">
+                <a href="{html_filename}" download="{html_filename}" target="_blank" 
+                   style="background-color: #4CAF50; color: white; padding: 5px 10px; 
+                          text-decoration: none; font-weight: bold; border-radius: 4px;">
+                    ⬇️ Download Interactive Plot
+                </a>
+                <span style="margin-left: 10px; color: #666;">
+                    (static preview below, download for interactive version)
+                </span>
+            </div>
+            <div>
+                <img src="data:image/png;base64,{img_b64}" style="max-width:100%; border: 1px solid #ddd;">
+            </div>
+            '''
+
+            # Display the combined HTML
+            _ActiveTask.display(HTML(download_html))
+            print("[Debug] Static image with download link displayed", file=stdout_stream)
+            return
+
+        # Fallback to just the download link if image fails
+        fallback_html = f'''
+        <div style="padding: 20px; background-color: #f8f9fa; border: 1px solid #ddd; margin: 10px 0;">
+            <p>Interactive plot saved to <code>{html_filename}</code></p>
+            <a href="{html_filename}" download="{html_filename}" target="_blank" 
+               style="background-color: #4CAF50; color: white; padding: 8px 15px; 
+                      text-decoration: none; font-weight: bold; display: inline-block;
+                      border-radius: 4px; margin-top: 10px;">
+                ⬇️ Download Interactive Plot
+            </a>
+        </div>
+        '''
+        _ActiveTask.display(HTML(fallback_html))
+        print("[Debug] Download link displayed (no preview available)", file=stdout_stream)
+
+    except Exception as e:
+        print(f"[Error] Plotly display error: {e}\n{_format_error(e)}", file=stderr_stream)
+
+
+def _patched_figure_show(self, *args, include_interactive=False, **kwargs):
+    """``go.Figure.show`` replacement; ``include_interactive=True`` also saves the HTML."""
+    print("[Debug] fig.show() called", file=_ActiveTask.stdout)
+    _display_plotly_figure(self, include_interactive)
+    return None
+
+
+def _patched_pio_show(fig, *args, include_interactive=False, **kwargs):
+    """``plotly.io.show`` replacement; ``include_interactive=True`` also saves the HTML."""
+    print("[Debug] pio.show() called", file=_ActiveTask.stdout)
+    _display_plotly_figure(fig, include_interactive)
+    return None
+
+
+def _save_and_show_figure(fig, filename=None):
+    """Save the figure to a file and display it as a static image with download link."""
+    print("[Debug] save_and_show_figure called", file=_ActiveTask.stdout)
+    _display_plotly_figure(fig, include_interactive=True, filename=filename)
+    return
+
+
+_kaleido_started = False
+_kaleido_lock = threading.Lock()
+
+
+def _start_kaleido():
+    """Keep one kaleido renderer running for the rest of this worker's life.
+
+    Done on the first figure export rather than when plotly is patched:
+    workers forked from a kernel that imported plotly are patched at once,
+    and would all start a headless browser whether they plot or not.
+    Kaleido >= 1.0 starts a browser per export unless a sync server is kept
+    running; older versions already reuse plotly's module-level scope.
+    """
+    global _kaleido_started
+    with _kaleido_lock:
+        if _kaleido_started:
             return
-    elif serialized_context is None:
-         output_queue.put(("stderr", task_id, "[Warning] Global context serialization failed, running without it.\n"))
+        _kaleido_started = True
+        try:
+            import kaleido
+            start_sync_server = getattr(kaleido, 'start_sync_server', None)
+            if start_sync_server is not None:
+                start_sync_server(silence_warnings=True)
+        except Exception:
+            pass # It cannot start here; to_image() reports why
+
+
+def _note(stream_name, text):
+    """Report setup progress: to the running cell, or with the next one."""
+    stream = _ActiveTask.stdout if stream_name == 'stdout' else _ActiveTask.stderr
+    if stream is not None:
+        print(text, file=stream)
+    else:
+        _worker_notes.append((stream_name, text))
+
+
+def _patch_matplotlib():
+    """Route ``plt.show()`` through the display publisher."""
+    try:
+        import matplotlib
+        import matplotlib.pyplot as plt
+
+        # Set a non-interactive backend for figure generation
+        matplotlib.use('Agg')
+
+        # Override the original show function
+        plt.show = _patched_show
+        _note('stdout', "[Debug] Matplotlib patched successfully")
+    except Exception as backend_err:
+        _note('stderr', f"[Warning] Failed to set Matplotlib backend: {backend_err}")
+
+
+def _patch_plotly():
+    """Route ``fig.show()`` / ``pio.show()`` through the display publisher."""
+    try:
+        import plotly
+        import plotly.graph_objects as go
+        import plotly.io as pio
+
+        # Print version info
+        _note('stdout', f"[Debug] Using Plotly version: {plotly.__version__}")
+
+        # Patch plotly Figure class and pio.show
+        go.Figure.show = _patched_figure_show
+        pio.show = _patched_pio_show
+        _note('stdout', "[Debug] Plotly successfully patched")
+    except Exception as plotly_err:
+        _note('stderr', f"[Warning] Failed to configure Plotly: {plotly_err}\n{_format_error(plotly_err)}")
+
+
+# Module whose first import triggers each patch
+_LAZY_PATCHES = {'matplotlib.pyplot': _patch_matplotlib, 'plotly': _patch_plotly}
+
+
+class _PatchingLoader(importlib.abc.Loader):
+    """Wraps a module's loader to run its patch once the module has executed."""
+
+    def __init__(self, loader, patch):
+        self._loader = loader
+        self._patch = patch
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name) # Resource readers, get_source...
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._loader.exec_module(module)
+        self._patch()
+
+
+class _PatchOnImport(importlib.abc.MetaPathFinder):
+    """Defers the plotting patches until user code imports the library.
+
+    Cells that never plot then never pay for importing matplotlib or plotly.
+    """
+
+    def __init__(self, patches):
+        self._patches = dict(patches)
+
+    def find_spec(self, fullname, path, target=None):
+        patch = self._patches.get(fullname)
+        if patch is None:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        del self._patches[fullname] # Patch once, even if this import fails
+        spec.loader = _PatchingLoader(spec.loader, patch)
+        return spec
+
+
+def _init_worker():
+    """Set up the plotting patches for this process, once.
+
+    Libraries already imported (e.g. inherited from the kernel through fork)
+    are patched right away; the others when a cell first imports them. The
+    patches are process-wide, so there is no need to redo them for every
+    cell. Returns the globals every cell starts from.
+    """
+    global _base_globals
+    if _base_globals is not None:
+        return _base_globals
+
+    pending = {}
+    for module_name, patch in _LAZY_PATCHES.items():
+        if module_name in sys.modules:
+            patch()
+        else:
+            pending[module_name] = patch
+    if pending:
+        sys.meta_path.insert(0, _PatchOnImport(pending))
+
+    from IPython import display as ipd
+    # Cells run as notebook code, not as part of this module: its helpers (and
+    # the pipes some of them hold) stay out of reach, and functions the cell
+    # defines belong to __main__ so they are returned by value.
+    _base_globals = {
+        '__name__': '__main__',
+        '__builtins__': builtins,
+        'HTML': HTML,
+        'Markdown': Markdown,
+        'IFrame': IFrame,
+        'ipd': ipd,
+        # Helper for saving a Plotly figure alongside its preview
+        'save_and_show_figure': _save_and_show_figure,
+    }
+    return _base_globals
+
+
+def worker_main(task_conn, output_queue: OutputChannel, result_conn, inherited=None):
+    """Main loop of a persistent worker: run each cell received on ``task_conn``.
+
+    Every task message carries only the globals that changed since the
+    previous one, so the worker keeps the serialized form of the rest. Values
+    are rebuilt from it for each run, which gives every cell a fresh copy
+    exactly as if the whole context had been sent again.
+
+    ``inherited`` is the context of the first cell when the worker was forked
+    with it. That cell runs on these objects, not on copies, but only on the
+    names it was also sent pickled: the others would be missing on a warm
+    worker too.
+    """
+    _init_worker() # Plotting libraries are imported before the first cell arrives
+    context_cache = {} # name, or tuple of names sharing objects -> (payload, buffers)
+    owners = {} # name -> its key in context_cache
+    while True:
+        try:
+            task = task_conn.recv()
+        except EOFError:
+            break # The kernel went away
+        if task is None:
+            break
+        code_str, task_id, updates, removed, warnings, from_inherited = task
+        for warning in warnings:
+            output_queue.put(("stderr", task_id, warning))
+        for name in removed:
+            _release_cache_key(context_cache, owners, name)
+        for key, (payload, buffer_count) in updates.items():
+            for name in (key if isinstance(key, tuple) else (key,)):
+                _release_cache_key(context_cache, owners, name)
+                owners[name] = key
+            context_cache[key] = (payload, [task_conn.recv_bytes() for _ in range(buffer_count)])
+
+        context = {}
+        if inherited is not None:
+            if from_inherited:
+                context = {name: value for name, value in inherited.items() if name in owners}
+            inherited = None
+        for key, (payload, buffers) in context_cache.items():
+            if all(name in context for name in (key if isinstance(key, tuple) else (key,))):
+                continue # Forked with it; the cache only serves the next cells
+            try:
+                # bytearray copies keep the arrays writable and the cache untouched
+                value = loads(payload, [bytearray(buf) for buf in buffers])
+            except Exception as e:
+                label = ', '.join(key) if isinstance(key, tuple) else key
+                output_queue.put(("stderr", task_id, f"[Warning] Failed to deserialize global variable '{label}': {e}\n"))
+                continue
+            if isinstance(key, tuple):
+                # Members rebound since are sent under their own keys
+                context.update((name, v) for name, v in value.items() if owners.get(name) == key)
+            else:
+                context[key] = value
+        run_code_in_background(code_str, output_queue, task_id, context, result_conn)
+
+def _release_cache_key(context_cache, owners, name):
+    """Forget ``name``'s cached value, keeping a shared entry while other names still use it."""
+    key = owners.pop(name, None)
+    if key is not None and key not in owners.values():
+        del context_cache[key]
+
+@functools.lru_cache(maxsize=128)
+def _compile_cell(code_str: str):
+    """Compile a cell once per worker; re-running it (parameter sweeps...) reuses the code object."""
+    return compile(code_str, '<string>', 'exec')
+
+
+# Methods whose call on a plain name marks that name as modified: res.append(i)
+_MUTATING_METHODS = frozenset({'append', 'extend', 'update', 'add'})
+
+
+def _target_names(target):
+    """Names bound by an assignment target, unpacking tuples, lists and ``*rest``."""
+    if isinstance(target, ast.Name):
+        yield target.id
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        for element in target.elts:
+            yield from _target_names(element)
+    elif isinstance(target, ast.Starred):
+        yield from _target_names(target.value)
+
+
+@functools.lru_cache(maxsize=128)
+def _assigned_names(code_str: str) -> frozenset:
+    """Names a cell assigns, loops over or mutates in place, found with one AST walk.
+
+    Catches what a line-based scan misses: multi-line statements, augmented
+    and annotated assignments, walrus targets and nested unpacking. A cell
+    that does not parse yields nothing (running it reports the error).
+    """
+    try:
+        tree = ast.parse(code_str)
+    except (SyntaxError, ValueError):
+        return frozenset()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                names.update(_target_names(target))
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign, ast.For, ast.AsyncFor, ast.NamedExpr)):
+            names.update(_target_names(node.target))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in _MUTATING_METHODS and isinstance(node.func.value, ast.Name):
+            names.add(node.func.value.id)
+    return frozenset(names)
+
+
+# Values of these types skip the unpicklable checks: they (nearly) always pickle,
+# and a rare failure is still caught by the namespace dump
+_SAFE_TYPES = (int, float, complex, bool, str, bytes, bytearray, type(None),
+               list, tuple, dict, set, frozenset)
+
+
+def _safe_types():
+    """``_SAFE_TYPES`` plus the NumPy/pandas containers, if something already imported them."""
+    extra = []
+    numpy = sys.modules.get('numpy')
+    if numpy is not None:
+        extra += [numpy.ndarray, numpy.generic]
+    pandas = sys.modules.get('pandas')
+    if pandas is not None:
+        extra += [pandas.DataFrame, pandas.Series, pandas.Index]
+    return _SAFE_TYPES + tuple(extra)
+
+
+# Never returned to the kernel, whatever the cell did with them. The runner's
+# own helpers are filtered by identity instead (see runner_globals), so any
+# other name a cell binds is the user's.
+_RESULT_EXCLUDE = frozenset({'__builtins__'})
+
+
+def run_code_in_background(code_str: str, output_queue: OutputChannel, task_id: str, context: dict | None = None, result_conn=None):
+    """Executes code, capturing stdout/stderr and display outputs.
+
+    ``context`` holds the globals copied from the kernel.
+    ``result_conn`` receives exactly one message when the cell is done: the
+    pickled ``SharedPayload`` of the returned variables, or ``b''`` if none.
+    """
+    # --- Initialize execution context ---
+    exec_globals = _init_worker().copy()
+    if context:
+        exec_globals.update(context)
 
     # --- Identify explicitly assigned variables ---
-    # Simple parsing to find variable assignments in the code
-    explicit_vars = set()
-    loop_vars = set()
-    
-    # Define important variables that should be included if they exist
-    important_vars = ['res', 'result', 'i', 'df', 'data']
-    
-    for line in code_str.split('\n'):
-        line = line.strip()
-        # Skip comments and empty lines
-        if not line or line.startswith('#'):
-            continue
-            
-        # Look for assignments (=) not in conditionals/loops
-        if '=' in line and not line.startswith(('if ', 'for ', 'while ', 'def ', 'class ')):
-            # Handle multi-assignments: x, y = 1, 2
-            var_part = line.split('=')[0].strip()
-            
-            # Handle list/tuple assignments with comma separators
-            for name in var_part.split(','):
-                name = name.strip()
-                if name and name.isidentifier():
-                    explicit_vars.add(name)
-                    
-        # Also look for append operations on lists: res.append(i)
-        elif '.append(' in line:
-            parts = line.split('.append(')
-            if parts and parts[0].strip().isidentifier():
-                explicit_vars.add(parts[0].strip())
-                
-        # Also capture for loop variables: for i in range(5)
-        elif line.startswith('for ') and ' in ' in line:
-            var_part = line[4:].split(' in ')[0].strip()
-            for name in var_part.split(','):
-                name = name.strip()
-                if name and name.isidentifier():
-                    loop_vars.add(name)
-    
-    # Add loop variables to explicit vars
-    explicit_vars.update(loop_vars)
-    
+    explicit_vars = _assigned_names(code_str)
+
+    # Diagnostics go out as a single stderr message at the end of the task
+    debug_lines = []
     if explicit_vars:
-        output_queue.put(("stderr", task_id, f"[Debug] Detected variable assignments: {', '.join(explicit_vars)}\n"))
+        debug_lines.append(f"[Debug] Detected variable assignments: {', '.join(explicit_vars)}\n")
 
     # --- Setup output redirection AND display hook ---
     stdout_stream = QueueStream(output_queue, task_id, 'stdout')
     stderr_stream = QueueStream(output_queue, task_id, 'stderr')
-    display_pub = QueueDisplayPublisher(output_queue, task_id)
+    stream_flusher = StreamFlusher(stdout_stream, stderr_stream)
+    stream_flusher.start()
+    display_pub = QueueDisplayPublisher(output_queue, task_id, stream_flusher)
 
     def custom_publish_display_data(data, metadata=None, **kwargs):
         """Sends display data over the queue instead of to ZMQ."""
@@ -147,298 +644,110 @@ def run_code_in_background(code_str: str, output_queue: Queue, task_id: str, ser
     # Custom display function for use in the background process
     def custom_display(obj):
         """Custom display function that routes through our queue system."""
-        if hasattr(obj, '_repr_html_'):
-            try:
-                html = obj._repr_html_()
-                if html:
-                    display_pub.publish({'text/html': html})
-                    return
-            except Exception as e:
-                print(f"[Warning] HTML display error: {e}", file=stderr_stream)
-                
-        # Fall back to repr if no HTML representation
         try:
-            display_pub.publish({'text/plain': repr(obj)})
+            # Every representation the object offers (HTML, PNG, plain...) in one pass
+            data, metadata = _display_formatter().format(obj)
         except Exception as e:
-            print(f"[Warning] Plain text display error: {e}", file=stderr_stream)
+            print(f"[Warning] Display formatting error: {e}", file=stderr_stream)
+            data, metadata = {'text/plain': repr(obj)}, {}
+        if not data:
+            data = {'text/plain': repr(obj)} # An empty bundle shows nothing
+        try:
+            display_pub.publish(data, metadata)
+        except Exception as e:
+            print(f"[Warning] Display error: {e}", file=stderr_stream)
     
     # Add our custom display function to the globals
-    from IPython import display as ipd
     exec_globals['display'] = custom_display
-    exec_globals['HTML'] = HTML
-    exec_globals['Markdown'] = Markdown
-    exec_globals['IFrame'] = IFrame
-    exec_globals['ipd'] = ipd
 
-    # --- Configure Matplotlib for background process ---
-    try:
-        import matplotlib
-        import matplotlib.pyplot as plt
-        import tempfile
-        
-        # Set a non-interactive backend for figure generation
-        matplotlib.use('Agg')
-        
-        # Override plt.show() to save and display figures in background process
-        def patched_show(*args, **kwargs):
-            for num, figmanager in enumerate(matplotlib._pylab_helpers.Gcf.get_all_fig_managers()):
-                fig = figmanager.canvas.figure
-                
-                # Create in-memory file-like object for PNG data
-                buf = io.BytesIO()
-                fig.savefig(buf, format='png', bbox_inches='tight')
-                buf.seek(0)
-                
-                # Encode image as base64 for HTML display
-                data = b64encode(buf.getvalue()).decode('utf-8')
-                html = f'<img src="data:image/png;base64,{data}">'
-                
-                # Send the image to the frontend via our custom display publisher
-                display_pub.publish({'text/html': html})
-                print("[Debug] Matplotlib figure displayed", file=stdout_stream)
-                
-                # Also support other formats like SVG if needed
-                # Implement additional formats here if needed
-            
-            # Clear the current figure to avoid double displaying
-            plt.clf()
-            plt.close('all')
-            
-            return None
-        
-        # Override the original show function
-        plt.show = patched_show
-        exec_globals['plt'] = plt
-        print("[Debug] Matplotlib patched successfully", file=stdout_stream)
-        
-    except ImportError:
-        # Matplotlib not available, ignore
-        pass
-    except Exception as backend_err:
-        print(f"[Warning] Failed to set Matplotlib backend: {backend_err}", file=stderr_stream)
-    # --- End Matplotlib Config ---
-    
-    # --- Configure Plotly for background process ---
-    try:
-        # Try to import and patch plotly
-        import plotly
-        import plotly.graph_objects as go
-        from plotly.io import to_html
-        import plotly.io as pio
-        
-        # Print version info
-        print(f"[Debug] Using Plotly version: {plotly.__version__}", file=stdout_stream)
-        
-        # Create plotly display function that uses static PNG approach with HTML file link
-        def display_plotly_figure(fig):
-            try:
-                print(f"[Debug] Display called for figure type: {type(fig)}", file=stdout_stream)
-                
-                # Step 1: Save the figure to an HTML file
-                html_filename = f"plotly_figure_{uuid.uuid4().hex[:8]}.html"
-                fig.write_html(html_filename, include_plotlyjs='cdn', full_html=True)
-                print(f"[Debug] Plotly figure saved to {html_filename}", file=stdout_stream)
-                
-                # Step 2: Generate a static PNG image
-                try:
-                    img_bytes = fig.to_image(format="png", scale=2, engine="kaleido")
-                    img_b64 = b64encode(img_bytes).decode('utf-8')
-                    
-                    # Step 3: Create HTML with static image and download link
-                    download_html = f'''
-                    <div style="margin: 10px 0;">
-                        <a href="{html_filename}" download="{html_filename}" target="_blank" 
-                           style="background-color: #4CAF50; color: white; padding: 5px 10px; 
-                                  text-decoration: none; font-weight: bold; border-radius: 4px;">
-                            ⬇️ Download Interactive Plot
-                        </a>
-                        <span style="margin-left: 10px; color: #666;">
-                            (static preview below, download for interactive version)
-                        </span>
-                    </div>
-                    <div>
-                        <img src="data:image/png;base64,{img_b64}" style="max-width:100%; border: 1px solid #ddd;">
-                    </div>
-                    '''
-                    
-                    # Display the combined HTML
-                    custom_display(HTML(download_html))
-                    print("[Debug] Static image with download link displayed", file=stdout_stream)
-                    return
-                    
-                except Exception as img_err:
-                    print(f"[Warning] Static image generation failed: {img_err}", file=stderr_stream)
-                    
-                    # Fallback to just the download link if image fails
-                    fallback_html = f'''
-                    <div style="padding: 20px; background-color: #f8f9fa; border: 1px solid #ddd; margin: 10px 0;">
-                        <p>Interactive plot saved to <code>{html_filename}</code></p>
-                        <a href="{html_filename}" download="{html_filename}" target="_blank" 
-                           style="background-color: #4CAF50; color: white; padding: 8px 15px; 
-                                  text-decoration: none; font-weight: bold; display: inline-block;
-                                  border-radius: 4px; margin-top: 10px;">
-                            ⬇️ Download Interactive Plot
-                        </a>
-                    </div>
-                    '''
-                    custom_display(HTML(fallback_html))
-                    print("[Debug] Download link displayed (no preview available)", file=stdout_stream)
-                    return
-                
-            except Exception as e:
-                print(f"[Error] Plotly display error: {e}\n{traceback.format_exc()}", file=stderr_stream)
-        
-        # Simple patch for fig.show() method
-        def patched_figure_show(self, *args, **kwargs):
-            print("[Debug] fig.show() called", file=stdout_stream)
-            display_plotly_figure(self)
-            return None
-        
-        # Patch plotly Figure class
-        go.Figure.show = patched_figure_show
-        
-        # Create a special save_and_show_figure function that users can call directly
-        def save_and_show_figure(fig, filename=None):
-            """Save the figure to a file and display it as a static image with download link."""
-            print("[Debug] save_and_show_figure called", file=stdout_stream)
-            display_plotly_figure(fig)
-            return
-        
-        # Add the function to the globals
-        exec_globals['save_and_show_figure'] = save_and_show_figure
-        
-        # Patch pio.show
-        def patched_pio_show(fig, *args, **kwargs):
-            print("[Debug] pio.show() called", file=stdout_stream)
-            display_plotly_figure(fig)
-            return None
-        
-        pio.show = patched_pio_show
-        
-        # Add imports to globals
-        try:
-            import plotly.express as px
-            exec_globals['px'] = px
-            print("[Debug] Plotly Express available", file=stdout_stream)
-        except ImportError:
-            print("[Warning] Plotly Express not available", file=stderr_stream)
-        
-        exec_globals['plotly'] = plotly
-        exec_globals['go'] = go
-        exec_globals['pio'] = pio
-        
-        print("[Debug] Plotly successfully patched", file=stdout_stream)
-        
-    except ImportError as ie:
-        print(f"[Warning] Plotly import error: {ie}", file=stderr_stream)
-    except Exception as plotly_err:
-        print(f"[Warning] Failed to configure Plotly: {plotly_err}\n{traceback.format_exc()}", file=stderr_stream)
-    # --- End Plotly Config ---
+    # --- Route the plotting hooks to this cell ---
+    _ActiveTask.display_pub = display_pub
+    _ActiveTask.display = custom_display
+    _ActiveTask.stdout = stdout_stream
+    _ActiveTask.stderr = stderr_stream
+    # What _init_worker had to say is shown once, with the first cell
+    for stream_name, text in _worker_notes:
+        print(text, file=stdout_stream if stream_name == 'stdout' else stderr_stream)
+    _worker_notes.clear()
 
+    result_message = b''
+    # Sent once, as the last message of the task, so the listener knows both
+    # how the cell ended and that nothing else is coming
+    final_status = "completed"
     try:
         output_queue.put(("status", task_id, "running"))
         
         # Store initial variable keys to track new or modified variables
         initial_var_keys = set(exec_globals.keys())
+        # Helpers this module put in the namespace, matched by identity so a kernel
+        # global of the same name (from IPython.display import display) does not
+        # shield them. They are only returned if the cell rebinds them; some hold
+        # this process's pipes.
+        runner_globals = dict(_init_worker(), display=custom_display,
+                              publish_display_data=custom_publish_display_data)
         
         with contextlib.redirect_stdout(stdout_stream), contextlib.redirect_stderr(stderr_stream):
-            exec(code_str, exec_globals)
-        output_queue.put(("status", task_id, "completed"))
-        
-        # Check for important variables and add them to explicit vars
-        for var in important_vars:
-            if var in exec_globals and var not in initial_var_keys:
-                explicit_vars.add(var)
-                output_queue.put(("stderr", task_id, f"[Debug] Adding important variable: {var}\n"))
+            try:
+                exec(_compile_cell(code_str), exec_globals)
+            finally:
+                # The cell's own output goes before any traceback or summary below
+                stream_flusher.flush()
         
-        # Collect globals and send back via manager dict if provided
-        if result_dict is not None:
-            # Track only new or potentially modified variables
-            current_var_keys = set(exec_globals.keys())
-            new_or_modified_keys = current_var_keys - initial_var_keys
-            
-            # Add variables that existed before but might have been modified
-            potentially_modified = initial_var_keys - set(['__builtins__', 'contextlib', 'QueueStream', 
-                                         'QueueDisplayPublisher', 'traceback', 'cloudpickle'])
-            
-            # Variables to transfer (new + potentially modified)
-            vars_to_transfer = new_or_modified_keys.union(potentially_modified)
-            
-            # Debug log for variable tracking
-            output_queue.put(("stderr", task_id, f"[Debug] New variables: {', '.join(sorted(new_or_modified_keys)[:20])}\n"))
-            
-            # Filter out non-serializable objects before sending back
+        # Collect globals and send them back over the result pipe, if any
+        if result_conn is not None:
+            # One pass over the namespace picks what goes back: everything the
+            # cell can see except untouched runner helpers.
             serializable_globals = {}
             skipped_vars = []
-            
-            # Process explicit assignments first to make sure they are included
-            for key in explicit_vars:
-                if key in exec_globals and key not in ('__builtins__', 'contextlib', 'QueueStream', 
-                                               'QueueDisplayPublisher', 'traceback', 'cloudpickle'):
-                    value = exec_globals[key]
-                    
-                    # Special handling for simple data types that should always work
-                    if isinstance(value, (int, float, str, bool, list, dict, tuple, set)):
-                        serializable_globals[key] = value
-                        output_queue.put(("stderr", task_id, f"[Debug] Including simple variable: {key} (type: {type(value).__name__})\n"))
-                        continue
-                    
-                    try:
-                        # Test if object can be pickled with cloudpickle
-                        cloudpickle.dumps(value)
-                        serializable_globals[key] = value
-                        output_queue.put(("stderr", task_id, f"[Debug] Including explicitly assigned variable: {key}\n"))
-                    except Exception as e:
-                        skipped_vars.append(key)
-                        output_queue.put(("stderr", task_id, f"[Warning] Cannot serialize explicitly assigned variable '{key}': {str(e)[:100]}...\n"))
-            
-            # Process other variables
-            for key in vars_to_transfer:
-                # Skip explicit vars (already processed) and internal objects
-                if key in explicit_vars or key.startswith('__') or key in ('__builtins__', 'contextlib', 'QueueStream', 
-                                                 'QueueDisplayPublisher', 'traceback', 'cloudpickle'):
+            new_keys = []
+            safe_types = _safe_types()
+            for key, value in exec_globals.items():
+                if key in _RESULT_EXCLUDE:
                     continue
-                
-                value = exec_globals[key]
-                
-                # Skip module objects and other known unpicklable objects
-                if is_module_or_unpicklable(value):
-                    skipped_vars.append(key)
+                if key not in initial_var_keys:
+                    new_keys.append(key)
+                explicit = key in explicit_vars
+                if not explicit and (key.startswith('__')
+                                     or (key in runner_globals and value is runner_globals[key])):
                     continue
-                
-                # Always include simple data types and collections
-                if isinstance(value, (int, float, str, bool, list, dict, tuple, set)):
+
+                # Always include simple data types, collections and arrays/frames
+                if isinstance(value, safe_types):
                     serializable_globals[key] = value
+                    if explicit:
+                        debug_lines.append(f"[Debug] Including simple variable: {key} (type: {type(value).__name__})\n")
                     continue
-                
-                try:
-                    # Test if object can be pickled with cloudpickle
-                    cloudpickle.dumps(value)
-                    serializable_globals[key] = value
-                except Exception as e:
-                    # Skip non-serializable objects but record them
+
+                # No trial pickling: values that fail are reported by the
+                # single namespace dump below, which isolates them.
+                if explicit:
+                    if never_pickles(value):
+                        skipped_vars.append(key)
+                        output_queue.put(("stderr", task_id, f"[Warning] Cannot serialize explicitly assigned variable '{key}': cannot pickle '{type(value).__name__}' object\n"))
+                        continue
+                    debug_lines.append(f"[Debug] Including explicitly assigned variable: {key}\n")
+                # Skip module objects and other known unpicklable objects
+                elif is_module_or_unpicklable(value) or never_pickles(value):
                     skipped_vars.append(key)
-                    output_queue.put(("stderr", task_id, f"[Warning] Cannot serialize variable '{key}': {str(e)[:100]}...\n"))
                     continue
+                serializable_globals[key] = value
+
+            # Debug log for variable tracking
+            debug_lines.append(f"[Debug] New variables: {', '.join(sorted(new_keys)[:20])}\n")
             
-            # Send serialized globals back via manager dict
+            # Send serialized globals back over the result pipe
             try:
-                # Use simpler approach: directly add variables to result_dict
-                # without additional serialization/deserialization
-                success_vars = []
-                
-                for key, value in serializable_globals.items():
-                    try:
-                        # Add directly to result dict
-                        result_dict[key] = value
-                        success_vars.append(key)
-                    except Exception as e:
-                        skipped_vars.append(key)
-                        output_queue.put(("stderr", task_id, f"[Warning] Failed to transfer variable '{key}': {str(e)[:100]}...\n"))
+                # One pickle and one message for all of them. Large buffers
+                # (arrays, frames) go through shared memory; the pipe only
+                # carries the SharedPayload descriptor.
+                shared, failed = namespace_to_shared(serializable_globals)
+                for key, e in failed.items():
+                    skipped_vars.append(key)
+                    output_queue.put(("stderr", task_id, f"[Warning] Failed to transfer variable '{key}': {str(e)[:100]}...\n"))
+                success_vars = [key for key in serializable_globals if key not in failed]
+                result_message = pickle.dumps(shared, protocol=pickle.HIGHEST_PROTOCOL)
                 
-                # Mark as completed so main process knows variables are ready
                 if success_vars:
-                    result_dict['__transfer_complete__'] = True
                     var_count = len(success_vars)
                     output_queue.put(("stdout", task_id, f"[Info] {var_count} variables returned to main process.\n"))
                     
@@ -456,7 +765,13 @@ def run_code_in_background(code_str: str, output_queue: Queue, task_id: str, ser
     except Exception as e:
         tb_str = traceback.format_exc()
         output_queue.put(("stderr", task_id, tb_str))
-        output_queue.put(("status", task_id, "error"))
+        final_status = "error"
     finally:
-        # No specific display hook cleanup needed with this approach
-        output_queue.put(("status", task_id, "finished_processing")) 
\ No newline at end of file
+        stream_flusher.stop()
+        _ActiveTask.display_pub = _ActiveTask.display = _ActiveTask.stdout = _ActiveTask.stderr = None
+        if result_conn is not None:
+            # Wake the parent's transfer thread even if user threads keep us alive
+            result_conn.send_bytes(result_message)
+        if debug_lines:
+            output_queue.put(("stderr", task_id, ''.join(debug_lines)))
+        output_queue.put(("status", task_id, final_status)) 
\ No newline at end of file
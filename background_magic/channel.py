@@ -0,0 +1,118 @@
+"""One-way message channel from a background process to its listener thread."""
+
+import pickle
+import queue
+import struct
+import threading
+from multiprocessing import Pipe
+
+# Frame tags. Stream text is sent as raw UTF-8 behind a one byte tag so the
+# hot path (every print in the background cell) never goes through pickle.
+# Status updates are plain strings too and take the same route.
+_TAG_PICKLED = b'P'
+# A pickled message whose out-of-band buffers follow as separate frames
+_TAG_PICKLED_BUFFERS = b'B'
+_BUFFER_COUNT = struct.Struct('<I')
+_TEXT_TAGS = {'stdout': b'o', 'stderr': b'e', 'status': b's'}
+_TEXT_TYPES = {tag[0]: msg_type for msg_type, tag in _TEXT_TAGS.items()}
+_TASK_ID_LEN = struct.Struct('B')
+
+
+class OutputChannel:
+    """Single-producer/single-consumer replacement for ``multiprocessing.Queue``.
+
+    The background process is the only writer and the listener thread the only
+    reader, so a one-way ``Pipe`` is enough: no feeder thread, no reader lock.
+    Messages keep the ``(msg_type, task_id, content)`` shape used by the queue.
+    ``pickle.PickleBuffer`` objects in a message are written straight from
+    their memory rather than copied into the pickle, and come out as bytes.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = Pipe(duplex=False)
+        # Guards the writer against threads started by user code in the child
+        self._write_lock = threading.Lock()
+        # The listener reads while a stopping worker drains and closes the reader
+        self._read_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_write_lock'], state['_read_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def put(self, message):
+        """Send a ``(msg_type, task_id, content)`` tuple to the listener."""
+        msg_type, task_id, content = message
+        tag = _TEXT_TAGS.get(msg_type)
+        if tag is not None and isinstance(content, str):
+            task_id_bytes = task_id.encode('utf-8')
+            frame = b''.join((tag, _TASK_ID_LEN.pack(len(task_id_bytes)), task_id_bytes,
+                              content.encode('utf-8', 'surrogatepass')))
+        else:
+            buffers = []
+            payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append)
+            if buffers:
+                with self._write_lock:
+                    self._writer.send_bytes(b''.join((_TAG_PICKLED_BUFFERS, _BUFFER_COUNT.pack(len(buffers)), payload)))
+                    for buf in buffers:
+                        self._writer.send_bytes(buf.raw())
+                return
+            frame = _TAG_PICKLED + payload
+        with self._write_lock:
+            self._writer.send_bytes(frame)
+
+    def get(self, timeout=None):
+        """Receive the next message, raising ``queue.Empty`` on timeout.
+
+        Raises ``EOFError`` once every writer has gone away (e.g. the process
+        died), or the reader was closed.
+        """
+        with self._read_lock:
+            if self._reader.closed:
+                raise EOFError
+            if not self._reader.poll(timeout):
+                raise queue.Empty
+            frame = self._reader.recv_bytes()
+            buffers = None
+            if frame[:1] == _TAG_PICKLED_BUFFERS:
+                count, = _BUFFER_COUNT.unpack_from(frame, 1)
+                buffers = [self._reader.recv_bytes() for _ in range(count)]
+        if buffers is not None:
+            return pickle.loads(memoryview(frame)[1 + _BUFFER_COUNT.size:], buffers=buffers)
+        text_type = _TEXT_TYPES.get(frame[0])
+        if text_type is None:
+            return pickle.loads(memoryview(frame)[1:])
+        id_end = 2 + frame[1]
+        return (text_type, frame[2:id_end].decode('utf-8'),
+                frame[id_end:].decode('utf-8', 'surrogatepass'))
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def get_many(self, timeout=None, max_messages=1000):
+        """Wait for one message, then return it with up to ``max_messages - 1`` already waiting.
+
+        Raises like ``get`` when nothing arrives at all. Capping the batch keeps
+        a chatty process from starving the caller's other work.
+        """
+        messages = [self.get(timeout)]
+        while len(messages) < max_messages:
+            try:
+                messages.append(self.get(timeout=0))
+            except (queue.Empty, EOFError):
+                break # A dead writer is reported on the next call
+        return messages
+
+    def close_writer(self):
+        """Close this process's copy of the write end (call in the parent after start)."""
+        self._writer.close()
+
+    def close(self):
+        """Close the read end once the process is gone; later reads raise ``EOFError``."""
+        with self._read_lock:
+            self._reader.close()
@@ -0,0 +1,346 @@
+"""Helpers for serializing namespaces sent to and from background processes."""
+
+import hashlib
+import io
+import os
+import pickle
+import socket
+import struct
+import sys
+import threading
+import types
+from multiprocessing.process import BaseProcess
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import cloudpickle
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Out-of-band buffers at least this large travel through shared memory
+SHARED_MEMORY_THRESHOLD = 64 * 1024
+# Windows frees a segment once its creator closes it, before the reader can attach
+SHARED_MEMORY_SUPPORTED = os.name == 'posix'
+
+# Types that no pickler can handle. Checking for them up front avoids a failing
+# dump, which is the slowest kind: cloudpickle walks the whole object first.
+# Modules, functions and classes are deliberately absent, they pickle fine.
+_NON_PICKLABLE_TYPES = (
+    types.GeneratorType, types.CoroutineType, types.AsyncGeneratorType,
+    types.FrameType, types.TracebackType,
+    io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom, io.TextIOWrapper,
+    socket.socket, threading.Thread, BaseProcess,
+    type(threading.Lock()), type(threading.RLock()),
+)
+# Kernel machinery (shells, sockets, comms) is tied to this process
+_NON_PICKLABLE_MODULES = ('ipykernel', 'zmq', 'IPython.core.interactiveshell', 'IPython.terminal')
+
+
+def _cached_whichmodule(whichmodule, maxsize=4096):
+    """Memoize cloudpickle's ``_whichmodule`` for objects without a ``__module__``.
+
+    For those it scans every module in ``sys.modules``, for every object
+    pickled. The cache is keyed by object identity (a reference is kept so
+    the id stays valid) and dropped whenever a module is imported, since the
+    answer can only change then.
+    """
+    cache = {}
+    module_count = len(sys.modules)
+
+    def cached(obj, name):
+        nonlocal module_count
+        if getattr(obj, '__module__', None) is not None:
+            return whichmodule(obj, name) # Cheap: no crawl involved
+        if len(sys.modules) != module_count or len(cache) >= maxsize:
+            cache.clear()
+            module_count = len(sys.modules)
+        key = (id(obj), name)
+        hit = cache.get(key)
+        if hit is not None and hit[0] is obj:
+            return hit[1]
+        module_name = whichmodule(obj, name)
+        cache[key] = (obj, module_name)
+        return module_name
+
+    cached.__wrapped__ = whichmodule
+    return cached
+
+
+_cloudpickle_module = getattr(cloudpickle, 'cloudpickle', None)
+if _cloudpickle_module is not None and hasattr(_cloudpickle_module, '_whichmodule') \
+        and not hasattr(_cloudpickle_module._whichmodule, '__wrapped__'):
+    _cloudpickle_module._whichmodule = _cached_whichmodule(_cloudpickle_module._whichmodule)
+
+
+def _dump_with(pickler_class, obj, buffer_callback, memo):
+    file = io.BytesIO()
+    pickler = pickler_class(file, protocol=PROTOCOL, buffer_callback=buffer_callback)
+    pickler.dump(obj)
+    memo.update(pickler.memo.copy())
+    return file.getvalue()
+
+
+def dumps(obj, buffers=None, memo=None):
+    """Pickle ``obj``, trying the C stdlib pickler before cloudpickle.
+
+    When ``buffers`` is a list, large buffers (NumPy arrays, pandas blocks...)
+    are appended to it out-of-band instead of being copied into the payload.
+    When ``memo`` is a dict, it receives the pickler's memo, ``id(o) -> (index, o)``
+    for every object the payload refers to more than trivially.
+    """
+    buffer_callback = buffers.append if buffers is not None else None
+    try:
+        if memo is None:
+            payload = pickle.dumps(obj, protocol=PROTOCOL, buffer_callback=buffer_callback)
+        else:
+            payload = _dump_with(pickle.Pickler, obj, buffer_callback, memo)
+        # The stdlib pickles functions and classes by reference. Anything defined
+        # in the notebook lives in __main__, which the child cannot import, so
+        # those need cloudpickle's by-value pickling instead.
+        if b'__main__' not in payload:
+            return payload
+    except Exception:
+        pass
+    if buffers is not None:
+        del buffers[:]
+    if memo is None:
+        return cloudpickle.dumps(obj, protocol=PROTOCOL, buffer_callback=buffer_callback)
+    memo.clear()
+    return _dump_with(cloudpickle.Pickler, obj, buffer_callback, memo)
+
+
+def loads(payload, buffers=()):
+    """Inverse of ``dumps``; ``buffers`` are the out-of-band buffers it collected."""
+    return pickle.loads(payload, buffers=buffers)
+
+
+def never_pickles(obj):
+    """Whether ``obj`` is of a type known to be unpicklable, without trying to pickle it."""
+    if isinstance(obj, _NON_PICKLABLE_TYPES):
+        return True
+    return type(obj).__module__.startswith(_NON_PICKLABLE_MODULES)
+
+
+def fingerprint(payload, buffers=()):
+    """Content hash of a ``dumps`` result, used to skip re-sending unchanged values."""
+    digest = hashlib.blake2b(payload, digest_size=16)
+    for buf in buffers:
+        digest.update(buf.raw() if isinstance(buf, pickle.PickleBuffer) else buf)
+    return digest.digest()
+
+
+def dumps_namespace(namespace: dict):
+    """Serialize ``namespace`` with as few pickle calls as possible.
+
+    The whole dict is dumped in one go. Only if that fails are the entries
+    bisected to find the unpicklable ones, which costs O(k log n) dumps for k
+    bad entries instead of probing every value separately.
+
+    Returns ``(payload, buffers, skipped)`` where ``buffers`` are the
+    out-of-band buffers to pass to ``loads`` and ``skipped`` maps each dropped
+    key to the exception raised while pickling it.
+    """
+    buffers = []
+    try:
+        return dumps(namespace, buffers), buffers, {}
+    except Exception as e:
+        first_error = e
+
+    skipped = {}
+    _bisect_unpicklable(list(namespace.items()), first_error, skipped)
+    picklable = {k: v for k, v in namespace.items() if k not in skipped}
+    buffers = []
+    return dumps(picklable, buffers), buffers, skipped
+
+
+def _bisect_unpicklable(items, error, skipped):
+    """Record the entries of ``items`` (known to fail with ``error``) that cannot be pickled."""
+    if len(items) == 1:
+        skipped[items[0][0]] = error
+        return
+    middle = len(items) // 2
+    for half in (items[:middle], items[middle:]):
+        try:
+            # Probes collect large buffers out-of-band so they are never copied
+            dumps(dict(half), [])
+        except Exception as e:
+            _bisect_unpicklable(half, e, skipped)
+
+
+# Tagged records for scalars: tag, name length, value length, name, value
+_PRIMITIVE_HEADER = struct.Struct('<cHI')
+# Largest name and value lengths the header's H and I fields can hold
+_MAX_PRIMITIVE_NAME = 0xFFFF
+_MAX_PRIMITIVE_DATA = 0xFFFFFFFF
+_FLOAT = struct.Struct('<d')
+_CONSTANTS = {b'T': True, b'F': False, b'N': None}
+_CONSTANT_TAGS = {True: b'T', False: b'F', None: b'N'}
+
+
+def _encode_primitive(value):
+    """Return ``(tag, data)`` for a plain scalar, or None if it needs pickle."""
+    value_type = type(value)
+    # Exact type checks: subclasses (enums, numpy scalars...) must keep their type
+    if value_type is bool or value is None:
+        return _CONSTANT_TAGS[value], b''
+    if value_type is int:
+        return b'i', value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+    if value_type is float:
+        return b'f', _FLOAT.pack(value)
+    if value_type is str:
+        return b's', value.encode('utf-8', 'surrogatepass')
+    if value_type is bytes:
+        return b'b', value
+    return None
+
+
+def encode_primitives(namespace: dict):
+    """Split plain scalars (int, float, str, bytes, bool, None) out of ``namespace``.
+
+    Returns ``(encoded, rest)``. The scalars are written as tagged binary
+    records, which is cheaper than pickle's framing for the many cells that
+    only return a few numbers or strings; ``rest`` still needs pickling.
+    """
+    records = []
+    rest = {}
+    for name, value in namespace.items():
+        encoded = _encode_primitive(value)
+        if encoded is None:
+            rest[name] = value
+            continue
+        tag, data = encoded
+        name_bytes = name.encode('utf-8')
+        if len(name_bytes) > _MAX_PRIMITIVE_NAME or len(data) > _MAX_PRIMITIVE_DATA:
+            rest[name] = value # Too long for the header; pickle has no such limit
+            continue
+        records.append(_PRIMITIVE_HEADER.pack(tag, len(name_bytes), len(data)))
+        records.append(name_bytes)
+        records.append(data)
+    return b''.join(records), rest
+
+
+def decode_primitives(encoded: bytes) -> dict:
+    """Inverse of ``encode_primitives``."""
+    namespace = {}
+    view = memoryview(encoded)
+    offset = 0
+    while offset < len(view):
+        tag, name_len, data_len = _PRIMITIVE_HEADER.unpack_from(view, offset)
+        offset += _PRIMITIVE_HEADER.size
+        name = bytes(view[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+        data = view[offset:offset + data_len]
+        offset += data_len
+        if tag in _CONSTANTS:
+            value = _CONSTANTS[tag]
+        elif tag == b'i':
+            value = int.from_bytes(data, 'little', signed=True)
+        elif tag == b'f':
+            value = _FLOAT.unpack(data)[0]
+        elif tag == b's':
+            value = bytes(data).decode('utf-8', 'surrogatepass')
+        else:
+            value = bytes(data)
+        namespace[name] = value
+    return namespace
+
+
+class SharedPayload:
+    """A pickled value whose large buffers were placed in shared memory segments.
+
+    Each entry of ``buffers`` is either the bytes of a small buffer or the
+    ``(name, size)`` of a ``SharedMemory`` segment holding a large one.
+    For a namespace, ``primitives`` holds its scalars in ``encode_primitives``
+    form; they are merged into the dict on load.
+    """
+
+    def __init__(self, payload: bytes, buffers: list, primitives: bytes = b''):
+        self.payload = payload
+        self.buffers = buffers
+        self.primitives = primitives
+
+    def load(self):
+        """Rebuild the value, copying each segment out once and unlinking it."""
+        buffers = []
+        try:
+            for buf in self.buffers:
+                if isinstance(buf, tuple):
+                    shm = SharedMemory(name=buf[0])
+                    try:
+                        buffers.append(bytearray(shm.buf[:buf[1]]))
+                    finally:
+                        shm.close()
+                        shm.unlink()
+                else:
+                    buffers.append(buf)
+        except BaseException:
+            self.discard()
+            raise
+        self.buffers = []
+        value = loads(self.payload, buffers)
+        if self.primitives:
+            value.update(decode_primitives(self.primitives))
+        return value
+
+    def discard(self):
+        """Unlink any segments that were never loaded."""
+        for buf in self.buffers:
+            if isinstance(buf, tuple):
+                try:
+                    shm = SharedMemory(name=buf[0])
+                    shm.close()
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+        self.buffers = []
+
+
+def _create_segment(size):
+    """Create a segment owned by whoever reads it, not by this process's resource tracker."""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(create=True, size=size, track=False)
+    shm = SharedMemory(create=True, size=size)
+    # Otherwise the tracker unlinks it as "leaked" as soon as this process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def to_shared(obj, threshold=SHARED_MEMORY_THRESHOLD):
+    """Pickle ``obj`` into a ``SharedPayload``, moving buffers >= ``threshold`` bytes to shared memory."""
+    pickle_buffers = []
+    payload = dumps(obj, pickle_buffers)
+    return _share_buffers(payload, pickle_buffers, threshold)
+
+
+def namespace_to_shared(namespace: dict, threshold=SHARED_MEMORY_THRESHOLD):
+    """``dumps_namespace`` into a single ``SharedPayload``.
+
+    Returns ``(shared, skipped)``; loading ``shared`` gives the picklable part
+    of ``namespace`` back as one dict. Plain scalars bypass pickle entirely.
+    """
+    primitives, rest = encode_primitives(namespace)
+    payload, pickle_buffers, skipped = dumps_namespace(rest)
+    if not SHARED_MEMORY_SUPPORTED:
+        threshold = float('inf')
+    shared = _share_buffers(payload, pickle_buffers, threshold)
+    shared.primitives = primitives
+    return shared, skipped
+
+
+def _share_buffers(payload, pickle_buffers, threshold):
+    shared = SharedPayload(payload, [])
+    try:
+        for pickle_buffer in pickle_buffers:
+            raw = pickle_buffer.raw()
+            if raw.nbytes < threshold:
+                shared.buffers.append(bytes(raw))
+                continue
+            shm = _create_segment(raw.nbytes)
+            try:
+                shm.buf[:raw.nbytes] = raw
+                shared.buffers.append((shm.name, raw.nbytes))
+            finally:
+                shm.close() # The receiving side unlinks it
+    except BaseException:
+        shared.discard()
+        raise
+    return shared
@@ -0,0 +1,281 @@
+"""Parent-side handle for a persistent background worker process."""
+
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe, Process
+
+from .background_runner import worker_main
+from .channel import OutputChannel
+from .serialization import SharedPayload, dumps, fingerprint, never_pickles
+
+logger = logging.getLogger(__name__)
+
+# Pickling a large namespace can take seconds, so it happens on this thread
+# instead of the kernel's. A single thread also keeps tasks in submission order.
+_serializer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='background-serializer')
+
+
+# Values whose identity the cell cannot observe, so aliases of them need no grouping
+_IMMUTABLE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+# Objects that must stay one object when two globals reach them, besides the
+# globals themselves: the mutable built-in containers (a shared instance shows
+# up through its ``__dict__``). Type objects, dtypes and the like are left out,
+# or every pair of arrays would be sent together.
+_SHARED_CONTAINER_TYPES = (list, dict, set, bytearray)
+
+
+def _shared_groups(context, memos):
+    """Keys to send the dumped globals under: a tuple for names sharing objects, else the name.
+
+    Each global is pickled on its own so unchanged ones can be skipped, which
+    would hand the worker a separate copy of whatever two globals share, be it
+    an alias (``b = a``) or a container holding another global (``d = {'k': a}``).
+    ``memos`` maps each name to the memo of its pickle; names whose pickles
+    reference a common object are sent together in one pickle instead.
+    """
+    global_ids = {id(context[name]) for name in memos if not isinstance(context[name], _IMMUTABLE_TYPES)}
+    parent = {name: name for name in memos}
+
+    def root(name):
+        while parent[name] != name:
+            parent[name] = name = parent[parent[name]]
+        return name
+
+    first_seen = {} # id -> a name whose pickle references that object
+    for name, memo in memos.items():
+        for obj_id, (_, obj) in memo.items():
+            if obj_id not in global_ids and not isinstance(obj, _SHARED_CONTAINER_TYPES):
+                continue
+            other = first_seen.setdefault(obj_id, name)
+            if other != name:
+                parent[root(other)] = root(name)
+
+    groups = {}
+    for name in memos:
+        groups.setdefault(root(name), []).append(name)
+    return [group[0] if len(group) == 1 else tuple(group) for group in groups.values()]
+
+
+def _modified_while_pickled(error):
+    """Whether ``error`` is what pickling a dict or set raises when another thread resizes it."""
+    return isinstance(error, RuntimeError) and 'changed size during iteration' in str(error)
+
+
+def _dump(value, buffers, memo=None):
+    """``dumps``, retried once if a cell running meanwhile resized a dict or set inside ``value``."""
+    try:
+        return dumps(value, buffers, memo)
+    except RuntimeError as e:
+        if not _modified_while_pickled(e):
+            raise
+    del buffers[:]
+    if memo is not None:
+        memo.clear()
+    return dumps(value, buffers, memo)
+
+
+def discard_pending(channel):
+    """Drop every message still queued on ``channel``, unlinking the shared memory of unread displays.
+
+    Segments are not tracked (see ``serialization._create_segment``), so the
+    figures of a stopped task would otherwise outlive the kernel.
+    """
+    while True:
+        try:
+            messages = channel.get_many(timeout=0)
+        except (queue.Empty, EOFError, OSError):
+            return
+        for _, _, content in messages:
+            if isinstance(content, SharedPayload):
+                content.discard()
+
+
+class BackgroundWorker:
+    """A long-lived process that runs ``%%background`` cells one at a time.
+
+    Starting a process and importing the scientific stack for every cell is
+    most of the cost of a short background run, so workers are kept warm and
+    reused. The worker remembers the serialized globals it was last sent;
+    ``submit`` only ships the entries whose content hash changed since.
+
+    With the fork start method, a ``context`` given here is inherited by the
+    child as part of the forked memory, and the first ``submit`` of that same
+    dict runs on those objects instead of unpickled copies. It is still
+    pickled, off the kernel's thread, so the worker can keep its cache and
+    drops the same globals a warm worker would. Other start methods (spawn,
+    forkserver) start from a fresh interpreter and always unpickle.
+    """
+
+    def __init__(self, namespace=None, context=None):
+        self.namespace = namespace
+        self.output_queue = OutputChannel()
+        child_task_conn, self.task_conn = Pipe(duplex=False)
+        # One message per task: the pickled SharedPayload of its variables, or b''
+        self.result_conn, child_result_conn = Pipe(duplex=False)
+        self._result_lock = threading.Lock() # discard_result runs on two threads at a stop
+        self._stop_lock = threading.Lock()
+        self._stopped = False
+        # name -> fingerprint of the value the worker currently holds
+        self._synced = {}
+        self._inherited_context = None
+        inherited = None
+        if context is not None and multiprocessing.get_start_method() == 'fork':
+            self._inherited_context = context
+            # Keep the same skip rules as the pickled path
+            inherited = {k: v for k, v in context.items() if not never_pickles(v)}
+        self.process = Process(
+            target=worker_main,
+            args=(child_task_conn, self.output_queue, child_result_conn, inherited),
+            daemon=True
+        )
+        self.process.start()
+        # The child owns these ends now; lets the listener see EOF if it dies
+        child_task_conn.close()
+        child_result_conn.close()
+        self.output_queue.close_writer()
+
+    def is_alive(self):
+        return not self._stopped and self.process.is_alive()
+
+    def submit(self, code_str, task_id, context: dict):
+        """Queue a cell to run against ``context`` and return at once.
+
+        ``context`` is pickled and sent from the serializer thread; the
+        returned ``Future`` resolves once the worker has been sent everything,
+        and holds the exception if that failed (the worker then never runs the
+        cell, so the caller has to stop it).
+        Entries that cannot be pickled are dropped: each is logged, and the
+        worker lists them in one warning line of the cell's output.
+
+        The mapping is copied here, but its values are captured when they are
+        pickled, not now: a cell run meanwhile that mutates one in place can
+        change what the worker gets. A value that keeps changing while it is
+        pickled is dropped too, and reported as such.
+        """
+        # The worker was forked with this context. It is pickled all the same: that
+        # fills the worker's cache and _synced, and finds the globals a warm worker
+        # would not get, which the forked one then drops as well.
+        inherited = context is self._inherited_context
+        self._inherited_context = None
+        return _serializer.submit(self._send_task, code_str, task_id, dict(context), inherited)
+
+    def _send_task(self, code_str, task_id, context, inherited):
+        dumped = {} # name -> (payload, buffers, digest)
+        memos = {} # name -> memo of its pickle, which also keeps the ids in it valid
+        skipped = {}
+        for name, value in context.items():
+            if never_pickles(value):
+                skipped[name] = TypeError(f"cannot pickle '{type(value).__name__}' object")
+                continue
+            buffers = []
+            memo = {}
+            try:
+                payload = _dump(value, buffers, memo)
+            except Exception as e:
+                skipped[name] = e
+                continue
+            dumped[name] = (payload, buffers, fingerprint(payload, buffers))
+            memos[name] = memo
+
+        updates = {}
+        update_buffers = []
+        groups = _shared_groups(context, memos)
+        memos.clear()
+        for key in groups:
+            names = key if isinstance(key, tuple) else (key,)
+            synced = [(dumped[name][2], key) for name in names]
+            if all(self._synced.get(name) == state for name, state in zip(names, synced)):
+                continue
+            if isinstance(key, tuple):
+                # One dump shares the pickle memo, so the worker gets one object back too
+                buffers = []
+                try:
+                    payload = _dump({name: context[name] for name in names}, buffers)
+                except Exception as e:
+                    skipped.update(dict.fromkeys(names, e))
+                    continue
+            else:
+                payload, buffers, _ = dumped[key]
+            updates[key] = (payload, len(buffers))
+            update_buffers.extend(buffers)
+            self._synced.update(zip(names, synced))
+
+        removed = [name for name in self._synced if name not in context or name in skipped]
+        for name in removed:
+            del self._synced[name]
+
+        warnings = []
+        changed = [name for name, error in skipped.items() if _modified_while_pickled(error)]
+        for name, error in skipped.items():
+            if name in changed:
+                logger.warning("Skipping global variable %r: it was modified while being pickled "
+                               "(by a cell run meanwhile?): %s", name, error)
+            else:
+                logger.warning("Skipping non-serializable global variable %r (type: %s): %s",
+                               name, type(context[name]).__name__, error)
+        # One short line each, printed by the worker, so the cell's own output says it too
+        if len(changed) < len(skipped):
+            unpicklable = [name for name in skipped if name not in changed]
+            warnings.append(f"[Warning] Skipped non-serializable globals: {', '.join(unpicklable)}\n")
+        if changed:
+            warnings.append(f"[Warning] Skipped globals modified while being sent: {', '.join(changed)}\n")
+        try:
+            self.task_conn.send((code_str, task_id, updates, removed, warnings, inherited))
+            # Large buffers are written straight from the object's memory, no copy
+            for buf in update_buffers:
+                self.task_conn.send_bytes(buf.raw())
+        except (OSError, ValueError):
+            pass # The task was stopped while its context was being pickled
+
+    def wait_handle(self):
+        """Objects to ``multiprocessing.connection.wait`` on for the current task."""
+        return [self.result_conn, self.process.sentinel]
+
+    def stop(self):
+        """Terminate the worker, killing it if it does not exit promptly, and close its pipes.
+
+        Whatever it sent and nobody read is dropped. Stopping twice is a no-op.
+        """
+        with self._stop_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(timeout=0.5)
+                if self.process.is_alive():
+                    self.process.kill()
+                    self.process.join(timeout=0.2)
+            self.discard_result()
+            discard_pending(self.output_queue)
+            self.task_conn.close()
+            self.result_conn.close()
+            self.output_queue.close()
+            if not self.process.is_alive():
+                self.process.close() # Its sentinel
+
+    def discard_result(self):
+        """Unlink the shared memory of a result sent just before a stop, which nobody will load."""
+        with self._result_lock:
+            try:
+                while self.result_conn.poll():
+                    message = self.result_conn.recv_bytes()
+                    if message:
+                        pickle.loads(message).discard()
+            except Exception:
+                pass # Closed, or cut off mid-message by the kill
+
+    def shutdown(self):
+        """Ask an idle worker to exit."""
+        if self._stopped:
+            return
+        try:
+            self.task_conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=0.5)
+        self.stop()
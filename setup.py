@@ -12,6 +12,9 @@ setup(
         'cloudpickle', # For serializing execution context
     ],
     extras_require={
+        'fast': [
+            'xxhash', # Faster cell identity hashing
+        ],
         'test': [
             'pandas', # For DataFrame testing
             'numpy',  # Dependency for pandas and testing
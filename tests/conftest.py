@@ -0,0 +1,59 @@
+import pytest
+from IPython.terminal.interactiveshell import TerminalInteractiveShell
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="also run tests marked slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="slow; run with --runslow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
+# One shell for the whole session: resetting it and reloading the extension for every test is slow
+@pytest.fixture(scope='session')
+def shell():
+    """Get an IPython shell instance with the extension loaded."""
+    # Use instance() method for potentially better reliability in tests
+    shell = TerminalInteractiveShell.instance()
+    shell.reset(new_session=True)
+    shell.run_line_magic('load_ext', 'background_magic')
+    yield shell
+    try:
+        shell.run_line_magic('unload_ext', 'background_magic')
+    except KeyError:
+        pass
+    shell.reset(new_session=True)
+
+
+@pytest.fixture
+def ip(shell):
+    """The shared shell, with whatever the test left behind removed afterwards."""
+    baseline = set(shell.user_ns)
+    yield shell
+    magics = shell._background_magic_instance
+    # Stop its tasks and workers, so the next test starts from fresh ones
+    magics._unload_tasks()
+    magics._namespaces.clear()
+    for key in list(shell.user_ns):
+        if not key.startswith('_') and key not in baseline:
+            del shell.user_ns[key]
+
+
+@pytest.fixture
+def run_background(ip):
+    """Run a ``%%background`` cell and block until its variables are transferred.
+
+    Waits on the handle the magic returns, which is set only once the task's
+    output has been drained, so whatever the cell printed is written too.
+    """
+    def run(cell, timeout=10):
+        handle = ip.run_cell(cell).result
+        assert handle.wait(timeout), f"Background task did not finish within {timeout}s"
+        return handle
+    return run
@@ -1,65 +1,46 @@
 import pytest
 from IPython.testing.globalipapp import get_ipython
-# Try importing the shell class directly
-from IPython.terminal.interactiveshell import TerminalInteractiveShell
 import time
 import pandas as pd
 import os
-import tempfile
 import json
-import cloudpickle
 from queue import Queue # For capturing output in test
 from unittest.mock import patch, MagicMock # Add MagicMock
 import sys
-from io import StringIO
-
-# Fixture to get a fresh IPython instance for each test
-@pytest.fixture(scope='function')
-def ip():
-    """Get a fresh IPython shell instance."""
-    # Use instance() method for potentially better reliability in tests
-    shell = TerminalInteractiveShell.instance()
-    # Ensure user_ns is clean if reusing instances across tests (though scope='function' should handle this)
-    shell.reset(new_session=True)
-    shell.run_line_magic('load_ext', 'background_magic')
-    yield shell
-    # Cleanup after test
-    try:
-        shell.run_line_magic('unload_ext', 'background_magic')
-    except KeyError:
-        pass
-    shell.reset(new_session=True)
-    # It might be necessary to properly close/destroy the instance if instance() is used
-    # TerminalInteractiveShell.clear_instance()
+import asyncio
+import threading
+import importlib.util
+import logging
 
 # Placeholder test
 def test_placeholder():
     assert True 
 
-def test_background_accesses_globals(ip):
+@pytest.fixture(scope='module')
+def sample_df():
+    return pd.DataFrame({'a': [1, 2]})
+
+@pytest.fixture
+def sample_globals(sample_df):
+    """One global of each kind the background cell should be able to read."""
+    return {
+        'test_str': "hello",
+        'test_int': 123,
+        'test_list': [1, 'a'],
+        'test_dict': {'x': 1},
+        'test_df': sample_df,
+        'test_func': lambda x: x + 1,
+    }
+
+def test_background_accesses_globals(ip, run_background, sample_globals, sample_df):
     """Test if %%background can access various global types."""
     # Define globals in the IPython namespace
-    ip.user_ns['test_str'] = "hello"
-    ip.user_ns['test_int'] = 123
-    ip.user_ns['test_list'] = [1, 'a']
-    ip.user_ns['test_dict'] = {'x': 1}
-    test_df_original = pd.DataFrame({'a': [1, 2]})
-    ip.user_ns['test_df'] = test_df_original
-    ip.user_ns['test_func'] = lambda x: x + 1
-
-    # Temp file for pickled results
-    with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.pkl') as tmpfile:
-        result_filepath = tmpfile.name
+    ip.user_ns.update(sample_globals)
 
-    # Code to run in the background
-    # Access globals and pickle results (except status/error)
-    background_code = f"""
-import time
-import cloudpickle
-import json # For status/error structure
-import pandas as pd # Need pandas inside too
-
-results = {{}}
+    # Code to run in the background; 'results' comes back over the result pipe
+    # The cell imports nothing: test_df arrives through the global context
+    background_code = """
+results = {}
 try:
     # Store results directly
     results['str_val'] = test_str
@@ -72,71 +53,23 @@ try:
 except Exception as e:
     results['status'] = 'error'
     results['error'] = str(e)
-
-# Write results to the temp file using cloudpickle
-filepath = r'{result_filepath}'
-try:
-    with open(filepath, 'wb') as f:
-        cloudpickle.dump(results, f)
-except Exception as e:
-    # If pickling fails, try to write basic error status
-    try:
-        with open(filepath, 'w') as f_err: # Open as text for JSON
-             json.dump({{'status':'pickle_error', 'error': str(e)}}, f_err)
-    except Exception:
-        import sys
-        print(f"Failed to write test results: {{e}}", file=sys.stderr)
-
-time.sleep(0.5)
 """
 
-    ip.run_cell(f"%%background\n{background_code}")
-
-    max_wait_secs = 10
-    start_wait = time.time()
-    results_data = None
-    while time.time() - start_wait < max_wait_secs:
-        try:
-            if os.path.exists(result_filepath) and os.path.getsize(result_filepath) > 0:
-                # Load pickled results
-                with open(result_filepath, 'rb') as f:
-                    # Check if it's the fallback JSON error message first
-                    if result_filepath.endswith('.pkl'): # Should always be true here
-                        try:
-                            # Read first few bytes to see if it looks like JSON
-                            start_bytes = f.read(2)
-                            f.seek(0)
-                            if start_bytes == b'{{":': # Simple check for json start
-                                # Try loading as json error
-                                results_data = json.load(f)
-                            else:
-                                results_data = cloudpickle.load(f)
-                        except Exception as load_err:
-                             print(f"Failed to load results file: {load_err}")
-                             # Treat as error for assertion
-                             results_data = {'status': 'load_error', 'error': str(load_err)}
-                    else: # Should not happen with suffix='.pkl'
-                         results_data = {'status': 'wrong_suffix'}
-                break
-        except FileNotFoundError:
-            pass
-        time.sleep(0.5)
-
-    if os.path.exists(result_filepath):
-        os.remove(result_filepath)
-
-    assert results_data is not None, "Test results file was not created or was empty."
+    run_background(f"%%background\n{background_code}")
+    results_data = ip.user_ns.get('results')
+
+    assert results_data is not None, "Background task returned no results."
     assert results_data.get('status') == 'success', f"Background task failed: {results_data.get('error')}"
     assert results_data.get('str_val') == "hello"
     assert results_data.get('int_val') == 123
     assert results_data.get('list_val') == [1, 'a']
     assert results_data.get('dict_val') == {'x': 1}
     # Compare DataFrame using pandas equality check
-    pd.testing.assert_frame_equal(results_data.get('df_val'), test_df_original)
+    pd.testing.assert_frame_equal(results_data.get('df_val'), sample_df)
     assert results_data.get('func_val') == 11
 
 # Revived test: Checks if modules imported externally are usable internally
-def test_background_uses_imported_modules(ip):
+def test_background_uses_imported_modules(ip, run_background):
     """Test if %%background can use modules imported in the main scope."""
     # Import modules in the main IPython namespace
     ip.run_cell("import pandas as pd_alias")
@@ -148,20 +81,14 @@ def test_background_uses_imported_modules(ip):
     assert 'np_alias' in ip.user_ns
     assert 'time_alias' in ip.user_ns
 
-    # Temp file for results
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as tmpfile:
-        result_filepath = tmpfile.name
-
     # Code to run in the background
     # It attempts to use the aliases defined outside
     # NO internal imports are used here.
-    background_code = f"""
-import json # Still need json for writing result file
-
-results = {{}}
+    background_code = """
+results = {}
 try:
     # Attempt to use the aliases imported in the parent scope
-    df = pd_alias.DataFrame({{'col': [1, 2]}})
+    df = pd_alias.DataFrame({'col': [1, 2]})
     arr = np_alias.array([10, 20])
     time_alias.sleep(0.01) # Use time module
     results['df_shape'] = df.shape
@@ -171,52 +98,49 @@ try:
 except NameError as e:
     # Should NOT happen if module serialization works
     results['status'] = 'error'
-    results['error'] = f'NameError: {{e}}'
+    results['error'] = f'NameError: {e}'
 except Exception as e:
     results['status'] = 'error'
     results['error'] = str(e)
-
-# Write results to the temp file
-filepath = r'{result_filepath}'
-try:
-    with open(filepath, 'w') as f:
-        json.dump(results, f)
-except Exception as e:
-    # Fallback if writing fails
-    try:
-        with open(filepath, 'w') as f_err:
-            json.dump({{'status': 'write_error', 'error': str(e)}}, f_err)
-    except Exception:
-        pass # Ignore secondary write error
-
 """
 
-    ip.run_cell(f"%%background\n{background_code}")
-
-    # Wait for results
-    max_wait_secs = 10
-    start_wait = time.time()
-    results_data = None
-    while time.time() - start_wait < max_wait_secs:
-        try:
-            if os.path.exists(result_filepath) and os.path.getsize(result_filepath) > 0:
-                with open(result_filepath, 'r') as f:
-                    results_data = json.load(f)
-                break
-        except (FileNotFoundError, json.JSONDecodeError):
-            pass
-        time.sleep(0.5)
-
-    if os.path.exists(result_filepath):
-        os.remove(result_filepath)
+    run_background(f"%%background\n{background_code}")
+    results_data = ip.user_ns.get('results')
 
     # Assertions: Check if the background code could use the aliases
-    assert results_data is not None, "Test results file was not created or was empty."
+    assert results_data is not None, "Background task returned no results."
     assert results_data.get('status') == 'success', f"Background task failed: {results_data.get('error')}"
-    assert results_data.get('df_shape') == [2, 1]
+    assert results_data.get('df_shape') == (2, 1)
     assert results_data.get('arr_sum') == 30
     assert results_data.get('time_slept') is True
 
+def test_background_keeps_aliased_globals_shared(ip, run_background):
+    """Two names bound to one object stay one object in the worker and back in the kernel."""
+    # A fresh worker is forked with the globals; a warm one is sent them pickled
+    run_background("%%background\nwarm = True")
+    ip.run_cell("a = [1]\nb = a")
+    run_background("%%background\nb.append(2)\nsame = a is b")
+    assert ip.user_ns['same'] is True
+    assert ip.user_ns['a'] == [1, 2] and ip.user_ns['a'] is ip.user_ns['b']
+
+    # The warm worker picks up a rebinding that ends the alias, with no change in content
+    ip.run_cell("b = list(a)")
+    run_background("%%background\nsame = a is b")
+    assert ip.user_ns['same'] is False
+
+def test_background_keeps_objects_shared_through_containers(ip, run_background):
+    """A global held inside another global's container is still that global in a warm worker."""
+    run_background("%%background\nwarm = True")
+    ip.run_cell("a = [1]\nb = a\nd = {'k': a}")
+    run_background("%%background\nd['k'].append(2)\nsame = d['k'] is a and a is b")
+    assert ip.user_ns['same'] is True
+    assert ip.user_ns['a'] == [1, 2] and ip.user_ns['d']['k'] is ip.user_ns['a']
+
+    # Only the container changes: the global it holds is sent with it again
+    ip.run_cell("d['n'] = 0")
+    run_background("%%background\nsame = d['k'] is a")
+    assert ip.user_ns['same'] is True
+
 def capture_output_messages(ipython_shell, cell_code):
     """Runs a cell and captures display_pub messages (stdout, stderr, display_data)."""
     # Mock the display_pub.publish method to capture messages
@@ -260,8 +184,12 @@ def capture_output_messages(ipython_shell, cell_code):
     return parent_msg_id, captured_messages
 
 
-# Requires a kernel environment to properly test parent_header based isolation
-@pytest.mark.skipif(not pytest.importorskip("ipykernel"), reason="Requires ipykernel for proper header testing")
+# Requires a kernel environment to properly test parent_header based isolation.
+# Checked without importing ipykernel; an importorskip here would skip the whole module.
+requires_kernel = pytest.mark.skipif(importlib.util.find_spec("ipykernel") is None,
+                                     reason="Requires ipykernel for proper header testing")
+
+@requires_kernel
 def test_output_isolation(ip):
     """Test that output from concurrent cells goes to the correct place."""
 
@@ -271,38 +199,55 @@ def test_output_isolation(ip):
     cell1_code = """%%background
     import time
     print('CELL_1_OUTPUT_1')
-    time.sleep(2)
+    time.sleep(0.2)
     print('CELL_1_OUTPUT_2')
     """
     cell2_code = """%%background
     import time
     print('CELL_2_OUTPUT_1')
-    time.sleep(1)
+    time.sleep(0.1)
     print('CELL_2_OUTPUT_2')
     """
 
     # Mock the session.send method to capture messages
     original_session_send = ip.kernel.session.send
     all_captured_messages = [] # List to store tuples of (parent_msg_id, text_content)
+    # Set once both cells' two lines have arrived, however they were batched
+    expected_lines = 4
+    captured_lines = 0
+    all_output_seen = threading.Event()
 
     # Use MagicMock to allow arbitrary attribute access if needed by the code under test
     # Although session.send is directly patched here.
     mock_session = MagicMock(spec=ip.kernel.session)
 
     def capture_hook(stream, msg_type, content, parent=None, ident=None, buffers=None, track=False, header=None, metadata=None):
+        nonlocal captured_lines
         parent_msg_id = parent['header']['msg_id'] if parent and 'header' in parent and 'msg_id' in parent['header'] else None
         text_content = None
+        if isinstance(content, bytes): # Streams are sent pre-packed with the JSON packer
+            content = json.loads(content)
         # We are interested in 'stream' messages for this test
         if msg_type == 'stream' and 'text' in content:
             text_content = content['text']
             all_captured_messages.append((parent_msg_id, text_content))
+            captured_lines += len(text_content.splitlines())
+            if captured_lines >= expected_lines:
+                all_output_seen.set()
 
         # If we needed to simulate a reply, we could call original_session_send here,
         # but for capturing IOPub, we don't need to.
         # original_session_send(stream, msg_type, content, parent, ident, buffers, track, header, metadata)
 
-    # Patch the send method on the actual session object
+    def capture_raw_hook(stream, msg_list, flags=0, copy=True, ident=None):
+        # Stream messages are sent pre-serialized: [header, parent, metadata, content]
+        header, parent, _, content = (json.loads(part) for part in msg_list[:4])
+        capture_hook(stream, header['msg_type'], content, parent={'header': parent})
+
+    # Patch the send methods on the actual session object
+    original_session_send_raw = ip.kernel.session.send_raw
     ip.kernel.session.send = capture_hook
+    ip.kernel.session.send_raw = capture_raw_hook
 
     try:
         # Run cell 1
@@ -317,11 +262,12 @@ def test_output_isolation(ip):
         ip.run_cell(cell2_code)
 
         # Wait for background tasks
-        time.sleep(3.0)
+        all_output_seen.wait(timeout=5.0)
 
     finally:
-        # IMPORTANT: Restore the original session.send method
+        # IMPORTANT: Restore the original session.send methods
         ip.kernel.session.send = original_session_send
+        ip.kernel.session.send_raw = original_session_send_raw
 
     # Analyze captured messages
     outputs_for_cell1 = set()
@@ -344,29 +290,23 @@ def test_output_isolation(ip):
     assert outputs_for_cell1 == expected_cell1, "Output mismatch for cell 1"
     assert outputs_for_cell2 == expected_cell2, "Output mismatch for cell 2" 
 
-def test_skips_unserializable_globals(ip):
+def test_skips_unserializable_globals(ip, run_background, caplog):
     """Test that non-serializable globals are skipped with a warning, and others are passed."""
     # Define globals, including a non-serializable one (generator)
     ip.user_ns['good_var'] = "This should pass"
     ip.user_ns['bad_var'] = (x for x in range(3)) # Generator - typically not pickleable
     ip.user_ns['another_good'] = 12345
 
-    # Temp file for results
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as tmpfile:
-        result_filepath = tmpfile.name
-
     # Code to run in background
-    background_code = f"""
-import json
-
-results = {{'status': 'success'}} # Default to success
+    background_code = """
+results = {'status': 'success'} # Default to success
 try:
     # Check the good variables
     results['good_var_val'] = good_var
     results['another_good_val'] = another_good
 except Exception as e:
     results['status'] = 'error'
-    results['error'] = f'Error accessing good vars: {{e}}'
+    results['error'] = f'Error accessing good vars: {e}'
 
 # Intentionally try accessing the bad variable, expecting NameError
 try:
@@ -379,52 +319,261 @@ except Exception as e:
     # Other unexpected error
     results['status'] = 'error'
     results['error_accessing_bad'] = str(e)
-
-# Write results
-filepath = r'{result_filepath}'
-try:
-    with open(filepath, 'w') as f:
-        json.dump(results, f)
-except Exception as write_e:
-    print(f"ERROR writing results: {{write_e}}") # Print error to potentially captured stderr
-
 """
 
-    # Capture stderr to check for the warning message
-    original_stderr_write = sys.stderr.write
-    stderr_capture = StringIO()
-    sys.stderr.write = stderr_capture.write
-
-    try:
-        ip.run_cell(f"%%background\n{background_code}")
-
-        # Wait for results
-        max_wait_secs = 5
-        start_wait = time.time()
-        results_data = None
-        while time.time() - start_wait < max_wait_secs:
-            try:
-                if os.path.exists(result_filepath) and os.path.getsize(result_filepath) > 0:
-                    with open(result_filepath, 'r') as f:
-                        results_data = json.load(f)
-                    break
-            except (FileNotFoundError, json.JSONDecodeError):
-                pass
-            time.sleep(0.2)
-    finally:
-        # Restore stderr and close capture
-        sys.stderr.write = original_stderr_write
-        captured_stderr = stderr_capture.getvalue()
-        stderr_capture.close()
-        if os.path.exists(result_filepath):
-            os.remove(result_filepath)
+    with caplog.at_level(logging.WARNING, logger='background_magic'):
+        run_background(f"%%background\n{background_code}", timeout=5)
+    results_data = ip.user_ns.get('results')
 
     # Assertions
-    print("Captured Stderr:\n", captured_stderr) # Print captured stderr for debugging if needed
-    assert results_data is not None, "Test results file was not created or was empty."
+    assert results_data is not None, "Background task returned no results."
     assert results_data.get('status') == 'success', f"Background task failed: {results_data.get('error')}"
     assert results_data.get('good_var_val') == "This should pass"
     assert results_data.get('another_good_val') == 12345
     assert results_data.get('bad_var_accessible') is False, "Non-serializable variable was unexpectedly accessible."
-    # Check that the warning message was printed to stderr (might be fragile)
-    assert "[Warning] Skipping non-serializable global variable 'bad_var'" in captured_stderr 
\ No newline at end of file
+    # Check that the skipped variable was reported
+    assert any('bad_var' in record.getMessage() for record in caplog.records)
+
+def test_listener_coalesces_stream_output(ip):
+    """Consecutive stdout/stderr chunks drained together are sent as one stream message each."""
+    from background_magic import output_listener
+    import threading
+
+    sent = []
+    fake_kernel = MagicMock()
+    fake_kernel.session.send = lambda stream, msg_type, content, parent=None, ident=None: sent.append((msg_type, content))
+    ip.kernel = fake_kernel
+    try:
+        output_queue = Queue()
+        for chunk in ('a', 'b', 'c'):
+            output_queue.put(('stdout', 'task', chunk))
+        output_queue.put(('stderr', 'task', 'err'))
+        output_queue.put(('stdout', 'task', 'd'))
+        output_queue.put(('status', 'task', 'finished_processing'))
+
+        output_listener(output_queue, 'status_task', threading.Event(), {'header': {'msg_id': 'parent'}})
+    finally:
+        del ip.kernel
+
+    streams = [(c['name'], c['text']) for t, c in sent if t == 'stream']
+    assert streams == [('stdout', 'abc'), ('stderr', 'err'), ('stdout', 'd')]
+
+def test_listener_base64_encodes_binary_display_data(ip):
+    """Raw PNG bytes published in the background reach the frontend base64-encoded."""
+    from background_magic import output_listener
+    from background_magic.background_runner import QueueDisplayPublisher
+    from background_magic.channel import OutputChannel
+    import base64
+    import threading
+
+    sent = []
+    fake_kernel = MagicMock()
+    fake_kernel.session.send = lambda stream, msg_type, content, parent=None, ident=None: sent.append((msg_type, content))
+    ip.kernel = fake_kernel
+    try:
+        channel = OutputChannel()
+        png = b'\x89PNG\r\n' + bytes(range(256))
+        QueueDisplayPublisher(channel, 'task').publish({'image/png': png, 'text/plain': 'figure'})
+        # Large enough to travel through shared memory where that is supported
+        big_png = b'\x89PNG\r\n' + os.urandom(256 * 1024)
+        QueueDisplayPublisher(channel, 'task').publish({'image/png': big_png})
+        channel.put(('status', 'task', 'finished_processing'))
+
+        output_listener(channel, 'status_task', threading.Event(), {'header': {'msg_id': 'parent'}})
+    finally:
+        del ip.kernel
+
+    displays = [c for t, c in sent if t == 'display_data']
+    assert len(displays) == 2
+    assert displays[0]['data'] == {'image/png': base64.b64encode(png).decode('ascii'), 'text/plain': 'figure'}
+    assert displays[1]['data'] == {'image/png': base64.b64encode(big_png).decode('ascii')}
+
+def test_status_scheduler_rate_limits_updates():
+    """Status updates are sent at most once per interval and only when they change."""
+    from background_magic import _StatusScheduler
+
+    with patch('background_magic.display') as mock_display:
+        status = _StatusScheduler('status_task', interval=60)
+        status.set('<i>Running (0s)</i>')
+        status.tick()
+        assert mock_display.call_count == 1
+
+        # Within the interval, newer statuses are held back...
+        status.set('<i>Running (1s)</i>')
+        status.tick()
+        status.set('<i>Running (2s)</i>')
+        status.tick()
+        assert mock_display.call_count == 1
+
+        # ...and only the latest one is sent when flushed
+        status.flush()
+        assert mock_display.call_count == 2
+        assert mock_display.call_args.args[0].data == '<i>Running (2s)</i>'
+
+        # Unchanged content is never re-sent
+        status.flush()
+        assert mock_display.call_count == 2
+
+def test_listener_prepacks_stream_content_for_json_packer(ip):
+    """With the JSON packer, stream messages are assembled from pre-packed frames."""
+    pytest.importorskip('jupyter_client') # The listener takes extract_header from it
+    from background_magic import output_listener
+    import threading
+
+    sent = []
+    fake_kernel = MagicMock()
+    fake_kernel.session.packer = 'json'
+    fake_kernel.session.adapt_version = None
+    fake_kernel.session.metadata = {}
+    fake_kernel.session.pack = lambda obj: json.dumps(obj).encode('utf-8')
+    fake_kernel.session.msg_header = lambda msg_type: {'msg_type': msg_type}
+    fake_kernel.session.send_raw = lambda stream, msg_list: sent.append(msg_list)
+    ip.kernel = fake_kernel
+    try:
+        output_queue = Queue()
+        output_queue.put(('stdout', 'task', 'café "quoted"\n'))
+        output_queue.put(('status', 'task', 'finished_processing'))
+        output_listener(output_queue, 'status_task', threading.Event(), {'header': {'msg_id': 'parent'}})
+    finally:
+        del ip.kernel
+
+    assert len(sent) == 1
+    header, parent, metadata, content = sent[0]
+    assert json.loads(header) == {'msg_type': 'stream'}
+    assert json.loads(parent) == {'msg_id': 'parent'}
+    assert json.loads(metadata) == {}
+    assert json.loads(content) == {'name': 'stdout', 'text': 'café "quoted"\n'}
+
+def test_rerunning_cell_supersedes_previous_run(ip):
+    """Running the same cell again stops the run still in progress."""
+    magics = ip._background_magic_instance
+    cell = "%%background\nimport time\ntime.sleep(30)\n"
+    first = ip.run_cell(cell).result
+    first_record = magics._background_tasks[first.task_id]
+    first_worker = first_record.worker
+    second = ip.run_cell(cell).result
+
+    assert first.task_id not in magics._background_tasks
+    assert not first_worker.is_alive()
+    assert first_record.worker is None
+    assert magics._cell_hash_to_task_id[first_record.cell_hash] == second.task_id
+
+    # The superseded run's handle is released at once, and has no values to give
+    assert first.wait(timeout=1)
+    assert first.stopped()
+    with pytest.raises(RuntimeError, match="was stopped"):
+        first.res
+
+    async def await_first():
+        await first
+    with pytest.raises(RuntimeError, match="was stopped"):
+        asyncio.run(await_first())
+    magics._stop_task(second.task_id)
+    assert second.stopped()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="Counts open fds through /proc")
+def test_stopped_tasks_release_their_pipes(ip):
+    """Handles of stopped runs, kept alive as in Out/_, hold no worker fds."""
+    magics = ip._background_magic_instance
+    magics._unload_tasks()
+    before = len(os.listdir('/proc/self/fd'))
+    handles = [ip.run_cell(f"%%background\nimport time\ntime.sleep(30) # {i}").result for i in range(5)]
+    magics._unload_tasks()
+    assert all(handle.stopped() for handle in handles)
+    assert len(os.listdir('/proc/self/fd')) <= before
+
+
+def test_transfer_survives_result_pipe_closed_by_a_stop(ip, monkeypatch):
+    """A stop that closes the result pipe just before it is read ends the transfer quietly."""
+    thread_errors = []
+    monkeypatch.setattr(threading, 'excepthook', thread_errors.append)
+    magics = ip._background_magic_instance
+    handle = ip.run_cell("%%background\nimport time\ntime.sleep(30)").result
+    record = magics._background_tasks[handle.task_id]
+    worker = record.worker
+    record.stop_event.set() # The listener's part of a stop
+    # What _stop_task does, with the pipe closed before the transfer thread reads it
+    worker.result_conn.close()
+    worker.process.terminate()
+    assert handle.wait(timeout=5)
+    worker.stop()
+    assert thread_errors == []
+
+
+def test_failed_send_stops_the_task_and_reports_it(ip, run_background, monkeypatch, capsys):
+    """An unexpected error on the serializer thread ends the task instead of leaving it waiting."""
+    import background_magic.worker as worker_module
+    run_background("%%background\nwarm = True") # A warm worker fingerprints every global
+
+    def broken_fingerprint(*args):
+        raise RuntimeError("fingerprint failed")
+    monkeypatch.setattr(worker_module, 'fingerprint', broken_fingerprint)
+    ip.user_ns['sent_global'] = [1]
+    handle = ip.run_cell("%%background\nres = 1").result
+    assert handle.wait(timeout=5)
+    assert handle.stopped()
+    assert "fingerprint failed" in capsys.readouterr().err
+
+
+def test_injected_display_is_not_returned_over_a_kernel_display(ip, run_background, capsys):
+    """The worker's display() shadows the kernel's own during the cell, and is never sent back."""
+    ip.run_cell("from IPython.display import display")
+    kernel_display = ip.user_ns['display']
+    run_background("%%background\nx = 1")
+    assert ip.user_ns['display'] is kernel_display
+    assert "display" not in capsys.readouterr().err
+
+
+def test_handles_in_user_ns_are_not_sent_and_show_their_state(ip, run_background, caplog, capsys):
+    """A handle kept as `task = _` is left out of later cells' globals, and a bare `task` shows it."""
+    capsys.readouterr()
+    handle = ip.run_cell("%%background\nres = 1", store_history=True).result
+    assert handle.wait(5)
+    assert '<BackgroundHandle' not in capsys.readouterr().out # The magic's own result shows nothing
+    ip.user_ns['task'] = handle
+    with caplog.at_level(logging.WARNING, logger='background_magic'):
+        run_background("%%background\nseen = 'task' in globals()")
+    assert ip.user_ns['seen'] is False
+    assert not any('task' in record.getMessage() for record in caplog.records)
+
+    ip.run_cell("task", store_history=True)
+    assert f"<BackgroundHandle {handle.task_id} (done)>" in capsys.readouterr().out
+
+
+def test_global_modified_while_pickled_is_reported_as_such(ip, run_background, monkeypatch, caplog):
+    """A dump that fails because the value was being resized is not reported as unpicklable."""
+    import background_magic.worker as worker_module
+    real_dumps = worker_module.dumps
+
+    def racing_dumps(value, buffers=None, memo=None):
+        if isinstance(value, dict) and 'busy' in value:
+            raise RuntimeError("dictionary changed size during iteration")
+        return real_dumps(value, buffers, memo)
+    monkeypatch.setattr(worker_module, 'dumps', racing_dumps)
+    ip.user_ns['busy_dict'] = {'busy': 1}
+    with caplog.at_level(logging.WARNING, logger='background_magic'):
+        run_background("%%background\nfound = 'busy_dict' in globals()")
+    assert ip.user_ns['found'] is False
+    messages = [record.getMessage() for record in caplog.records if 'busy_dict' in record.getMessage()]
+    assert messages and all('modified while being pickled' in message for message in messages)
+
+
+def test_idle_worker_pool_is_capped_and_expires(ip, run_background, monkeypatch):
+    """Idle workers past the cap, or idle for too long, are shut down."""
+    import background_magic
+    magics = ip._background_magic_instance
+    monkeypatch.setattr(background_magic, 'MAX_IDLE_WORKERS', 1)
+    run_background("%%background ns_a\nx = 1")
+    first, _ = magics._idle_workers['ns_a']
+    run_background("%%background ns_b\nx = 1")
+    assert list(magics._idle_workers) == ['ns_b'] # The longest idle one made room
+    assert not first.is_alive()
+
+    monkeypatch.setattr(background_magic, 'IDLE_WORKER_TIMEOUT', 0.5)
+    magics._unload_tasks() # Drops ns_b, and the timer armed with the old timeout
+    run_background("%%background ns_c\nx = 1")
+    last, _ = magics._idle_workers['ns_c']
+    magics._reap_timer.join(timeout=5)
+    assert magics._idle_workers == {}
+    assert not last.is_alive()
@@ -0,0 +1,123 @@
+import queue
+import sys
+import types
+
+import cloudpickle
+import pytest
+
+from background_magic import background_runner
+from background_magic.channel import OutputChannel
+
+
+@pytest.fixture
+def run_in_process(monkeypatch):
+    """Run a cell with ``run_code_in_background`` in this process and return its messages.
+
+    The runner's once-per-process setup is undone afterwards, and the plotting
+    patches (an import hook, matplotlib's backend) are never installed.
+    """
+    monkeypatch.setattr(background_runner, '_base_globals', None)
+    monkeypatch.setattr(background_runner, '_LAZY_PATCHES', {})
+    monkeypatch.setattr(sys, 'meta_path', list(sys.meta_path))
+
+    def run(code):
+        channel = OutputChannel()
+        background_runner.run_code_in_background(code, channel, 'task')
+        messages = []
+        while not messages or messages[-1] != ('status', 'task', 'completed'):
+            messages.append(channel.get(timeout=5))
+        return messages
+    return run
+
+
+def test_background_display_sends_every_representation(run_in_process):
+    messages = run_in_process("display(HTML('<b>hi</b>'))")
+
+    displays = [content for msg_type, _, content in messages if msg_type == 'display_data']
+    assert len(displays) == 1
+    assert displays[0]['data']['text/html'] == '<b>hi</b>'
+    assert 'text/plain' in displays[0]['data']
+
+
+def test_background_display_skips_ipython_display_hook(run_in_process):
+    """An object's ``_ipython_display_`` would reach the kernel's sockets; its repr is shown instead."""
+    messages = run_in_process("class Widget:\n"
+                              "    def _ipython_display_(self):\n"
+                              "        print('hook called')\n"
+                              "    def __repr__(self):\n"
+                              "        return 'Widget()'\n"
+                              "display(Widget())\n")
+
+    displays = [content for msg_type, _, content in messages if msg_type == 'display_data']
+    assert [display['data'] for display in displays] == [{'text/plain': 'Widget()'}]
+    assert not any('hook called' in str(content) for msg_type, _, content in messages if msg_type == 'stdout')
+
+
+def test_plotting_patch_runs_when_library_is_first_imported(tmp_path, monkeypatch):
+    (tmp_path / 'fake_plotting_lib.py').write_text('show = "original"\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    patched = []
+
+    def patch():
+        module = sys.modules['fake_plotting_lib']
+        patched.append(module.show)
+        module.show = 'patched'
+
+    finder = background_runner._PatchOnImport({'fake_plotting_lib': patch})
+    monkeypatch.setattr(sys, 'meta_path', [finder] + sys.meta_path)
+    monkeypatch.delitem(sys.modules, 'fake_plotting_lib', raising=False)
+    assert not patched
+
+    import fake_plotting_lib
+    assert patched == ['original'] # Applied after the module ran, exactly once
+    assert fake_plotting_lib.show == 'patched'
+
+
+def test_kaleido_renderer_starts_once_on_first_export(monkeypatch):
+    """Workers that never export a figure never start kaleido's browser."""
+    started = []
+    fake_kaleido = types.ModuleType('kaleido')
+    fake_kaleido.start_sync_server = lambda **kwargs: started.append(kwargs)
+    monkeypatch.setitem(sys.modules, 'kaleido', fake_kaleido)
+    monkeypatch.setattr(background_runner, '_kaleido_started', False)
+
+    background_runner._start_kaleido()
+    background_runner._start_kaleido()
+    assert started == [{'silence_warnings': True}]
+
+
+def test_queue_stream_batches_writes_until_flushed(monkeypatch):
+    channel = OutputChannel()
+    stream = background_runner.QueueStream(channel, 'task', 'stdout')
+    print('a', file=stream)
+    print('b', file=stream)
+    with pytest.raises(queue.Empty):
+        channel.get(timeout=0.1)
+
+    stream.flush()
+    assert channel.get(timeout=1) == ('stdout', 'task', 'a\nb\n')
+
+    # A line ending a large enough chunk is sent right away
+    stream.write('y' * 1100)
+    with pytest.raises(queue.Empty):
+        channel.get(timeout=0.1)
+    stream.write('\n')
+    assert channel.get(timeout=1) == ('stdout', 'task', 'y' * 1100 + '\n')
+
+    # A full buffer is sent without waiting for the flusher
+    monkeypatch.setattr(background_runner, 'STREAM_BUFFER_SIZE', 16)
+    stream.write('x' * 16)
+    assert channel.get(timeout=1) == ('stdout', 'task', 'x' * 16)
+
+
+def test_display_publisher_sends_dict_and_falls_back_to_cloudpickle():
+    channel = OutputChannel()
+    publisher = background_runner.QueueDisplayPublisher(channel, 'task')
+    publisher.publish({'text/plain': 'x'})
+    assert channel.get(timeout=1) == ('display_data', 'task', {'data': {'text/plain': 'x'}, 'metadata': {}})
+
+    # The stdlib pickler cannot handle a lambda; the payload arrives cloudpickled instead
+    publisher.publish({'text/plain': 'y'}, metadata={'callback': lambda: 42})
+    msg_type, task_id, content = channel.get(timeout=1)
+    assert (msg_type, task_id) == ('display_data', 'task')
+    assert cloudpickle.loads(content)['metadata']['callback']() == 42
@@ -0,0 +1,78 @@
+import pickle
+import queue
+
+import pytest
+
+from background_magic.channel import OutputChannel
+
+
+def test_channel_round_trips_stream_and_pickled_messages():
+    """Stream text and arbitrary payloads come out in order with their original shape."""
+    channel = OutputChannel()
+    channel.put(('stdout', 'bg_task_1_abc', 'héllo\n'))
+    channel.put(('display_data', 'bg_task_1_abc', {'data': {'text/plain': 'x'}}))
+    channel.put(('stderr', 'bg_task_1_abc', ''))
+    channel.put(('status', 'bg_task_1_abc', 'finished_processing'))
+
+    assert channel.get(timeout=1) == ('stdout', 'bg_task_1_abc', 'héllo\n')
+    assert channel.get(timeout=1) == ('display_data', 'bg_task_1_abc', {'data': {'text/plain': 'x'}})
+    assert channel.get(timeout=1) == ('stderr', 'bg_task_1_abc', '')
+    assert channel.get(timeout=1) == ('status', 'bg_task_1_abc', 'finished_processing')
+    with pytest.raises(queue.Empty):
+        channel.get_nowait()
+
+
+def test_channel_sends_pickle_buffers_out_of_band():
+    channel = OutputChannel()
+    image = b'\x89PNG' * 1000
+    channel.put(('display_data', 'task', {'image/png': pickle.PickleBuffer(image)}))
+    channel.put(('stdout', 'task', 'after'))
+
+    assert channel.get(timeout=1) == ('display_data', 'task', {'image/png': image})
+    assert channel.get(timeout=1) == ('stdout', 'task', 'after')
+
+
+def test_channel_reports_eof_when_writer_closed():
+    channel = OutputChannel()
+    channel.close_writer()
+    with pytest.raises(EOFError):
+        channel.get(timeout=1)
+
+
+def test_channel_get_many_drains_waiting_messages_up_to_cap():
+    channel = OutputChannel()
+    for i in range(5):
+        channel.put(('stdout', 'task', str(i)))
+
+    assert [m[2] for m in channel.get_many(timeout=1, max_messages=3)] == ['0', '1', '2']
+    assert [m[2] for m in channel.get_many(timeout=1)] == ['3', '4']
+    with pytest.raises(queue.Empty):
+        channel.get_many(timeout=0.05)
+
+
+def test_discard_pending_unlinks_unread_shared_displays():
+    """A stopped task's queued figures leave no shared memory segments behind."""
+    from multiprocessing.shared_memory import SharedMemory
+    from background_magic.worker import discard_pending
+    from background_magic.serialization import to_shared
+
+    shared = to_shared({'image/png': pickle.PickleBuffer(b'\x89PNG' * 100000)})
+    names = [buf[0] for buf in shared.buffers if isinstance(buf, tuple)]
+    assert names
+    channel = OutputChannel()
+    channel.put(('display_data', 'task', shared))
+    channel.put(('stdout', 'task', 'never shown'))
+    channel.close_writer()
+
+    discard_pending(channel)
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def test_closed_channel_reads_as_eof():
+    channel = OutputChannel()
+    channel.put(('stdout', 'task', 'dropped'))
+    channel.close()
+    with pytest.raises(EOFError):
+        channel.get(timeout=1)
@@ -0,0 +1,157 @@
+import threading
+
+import cloudpickle
+
+from background_magic.serialization import dumps_namespace
+
+
+def test_dumps_namespace_single_pass_when_everything_pickles():
+    payload, buffers, skipped = dumps_namespace({'a': 1, 'b': [1, 2], 'f': lambda x: x + 1})
+    restored = cloudpickle.loads(payload, buffers=buffers)
+    assert skipped == {}
+    assert restored['a'] == 1 and restored['b'] == [1, 2]
+    assert restored['f'](1) == 2
+
+
+def test_dumps_namespace_isolates_unpicklable_entries():
+    namespace = {f'v{i}': i for i in range(10)}
+    namespace['gen'] = (x for x in range(3))
+    namespace['lock'] = threading.Lock()
+
+    payload, buffers, skipped = dumps_namespace(namespace)
+
+    assert set(skipped) == {'gen', 'lock'}
+    assert cloudpickle.loads(payload, buffers=buffers) == {f'v{i}': i for i in range(10)}
+
+
+def test_dumps_prefers_stdlib_pickle_and_keeps_buffers_out_of_band():
+    import pickle
+    import numpy as np
+    from background_magic.serialization import dumps, loads
+
+    arr = np.arange(100000)
+    buffers = []
+    payload = dumps({'arr': arr, 'n': 3}, buffers)
+
+    # A plain stdlib pickle stream, with the array data carried separately
+    assert len(buffers) == 1
+    assert len(payload) < arr.nbytes
+    restored = loads(payload, buffers)
+    np.testing.assert_array_equal(restored['arr'], arr)
+    assert restored['n'] == 3
+    assert pickle.loads(dumps([1, 'a'])) == [1, 'a']
+
+
+def test_dumps_falls_back_to_cloudpickle_for_main_objects():
+    from background_magic.serialization import dumps, loads
+
+    def local(x):
+        return x * 2
+    local.__module__ = '__main__'
+
+    assert loads(dumps(local))(4) == 8
+
+
+def test_to_shared_moves_large_buffers_to_shared_memory():
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from multiprocessing.shared_memory import SharedMemory
+    from background_magic.serialization import to_shared
+
+    arr = np.arange(50000, dtype='float64')
+    shared = to_shared(arr)
+    names = [buf[0] for buf in shared.buffers if isinstance(buf, tuple)]
+    assert len(names) == 1
+    np.testing.assert_array_equal(shared.load(), arr)
+    # Loading unlinks the segment
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=names[0])
+
+    df = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})
+    pd.testing.assert_frame_equal(to_shared(df).load(), df)
+
+
+def test_never_pickles_flags_known_unpicklable_types():
+    import io
+    import numpy as np
+    from background_magic.serialization import never_pickles
+
+    assert never_pickles(x for x in range(3))
+    assert never_pickles(threading.Lock())
+    assert never_pickles(threading.Thread(target=print))
+    # Modules, functions and ordinary data must still be attempted
+    assert not never_pickles(np)
+    assert not never_pickles(lambda x: x)
+    assert not never_pickles(io.BytesIO(b'data'))
+    assert not never_pickles({'a': 1})
+
+
+def test_namespace_to_shared_returns_one_payload_for_all_variables():
+    import numpy as np
+    from background_magic.serialization import namespace_to_shared
+
+    namespace = {'arr': np.arange(100000), 'small': [1, 2], 'bad': threading.Lock()}
+    shared, skipped = namespace_to_shared(namespace, threshold=1024)
+    assert list(skipped) == ['bad']
+    restored = shared.load()
+    assert sorted(restored) == ['arr', 'small']
+    assert np.array_equal(restored['arr'], namespace['arr'])
+
+
+def test_whichmodule_crawl_is_cached_until_a_module_is_imported():
+    import sys
+    import types
+    from background_magic.serialization import _cached_whichmodule
+
+    calls = []
+    def whichmodule(obj, name):
+        calls.append(name)
+        return None
+    cached = _cached_whichmodule(whichmodule)
+
+    def orphan():
+        pass
+    orphan.__module__ = None
+    cached(orphan, 'orphan')
+    cached(orphan, 'orphan')
+    assert calls == ['orphan']
+
+    sys.modules['_background_magic_test_module'] = types.ModuleType('_background_magic_test_module')
+    try:
+        cached(orphan, 'orphan')
+    finally:
+        del sys.modules['_background_magic_test_module']
+    assert calls == ['orphan', 'orphan']
+
+
+def test_primitives_round_trip_without_pickle():
+    import enum
+    from background_magic.serialization import decode_primitives, encode_primitives, namespace_to_shared
+
+    class Color(enum.IntEnum):
+        RED = 1
+
+    namespace = {'n': -2**70, 'zero': 0, 'x': 1.5, 's': 'héllo\udcff', 'b': b'\x00raw',
+                 'yes': True, 'nothing': None, 'color': Color.RED, 'items': [1, 2]}
+    encoded, rest = encode_primitives(namespace)
+    # Subclasses and containers are left for pickle so they keep their type
+    assert sorted(rest) == ['color', 'items']
+    decoded = decode_primitives(encoded)
+    assert decoded == {k: v for k, v in namespace.items() if k not in rest}
+    assert type(decoded['yes']) is bool and type(decoded['zero']) is int
+
+    shared, skipped = namespace_to_shared(namespace)
+    restored = shared.load()
+    assert restored == namespace and type(restored['color']) is Color
+
+
+def test_primitives_too_long_for_the_header_go_to_pickle():
+    from background_magic.serialization import encode_primitives, namespace_to_shared
+
+    long_name = 'n' * 70000
+    namespace = {long_name: 1, 'short': 2}
+    encoded, rest = encode_primitives(namespace)
+    assert list(rest) == [long_name]
+    shared, skipped = namespace_to_shared(namespace)
+    assert shared.load() == namespace and not skipped
@@ -1,5 +1,4 @@
 import pytest
-from IPython.terminal.interactiveshell import TerminalInteractiveShell
 import time
 import pandas as pd
 import numpy as np
@@ -8,117 +7,104 @@ import sys
 import io
 from contextlib import redirect_stdout, redirect_stderr
 
-@pytest.fixture(scope='function')
-def ip():
-    """Get a fresh IPython shell instance."""
-    shell = TerminalInteractiveShell.instance()
-    shell.reset(new_session=True)
-    shell.run_line_magic('load_ext', 'background_magic')
-    yield shell
-    try:
-        shell.run_line_magic('unload_ext', 'background_magic')
-    except KeyError:
-        pass
-    shell.reset(new_session=True)
-
-def test_global_variable_return(ip):
+
+def test_global_variable_return(ip, run_background):
     """Test if variables defined in background are returned to global namespace."""
     # Run code in background that defines variables
-    ip.run_cell("""%%background
+    run_background("""%%background
 import numpy as np
 test_var = 42
 test_arr = np.array([1, 2, 3])
 test_dict = {'key': 'value'}
 """)
     
-    # Wait for background process to complete
-    time.sleep(2)
-    
     # Check if variables are available in global namespace
     assert ip.user_ns.get('test_var') == 42
     assert 'test_arr' in ip.user_ns
     np.testing.assert_array_equal(ip.user_ns['test_arr'], np.array([1, 2, 3]))
     assert ip.user_ns.get('test_dict') == {'key': 'value'}
 
-def test_namespace_variable_isolation(ip):
+
+def test_names_of_runner_modules_are_returned(ip, run_background):
+    """Names the runner module uses internally are ordinary names in the cell's namespace."""
+    run_background("%%background\ncloudpickle = 3\ncontextlib = [1]\ntraceback = 'tb'")
+    assert ip.user_ns.get('cloudpickle') == 3
+    assert ip.user_ns.get('contextlib') == [1]
+    assert ip.user_ns.get('traceback') == 'tb'
+
+
+def test_namespace_variable_isolation(ip, run_background):
     """Test if variables in namespaces are isolated correctly."""
     # Run code in first namespace
-    ip.run_cell("""%%background ns1
+    run_background("""%%background ns1
 x = 100
 shared = "from_ns1"
 """)
     
     # Run code in second namespace
-    ip.run_cell("""%%background ns2
+    run_background("""%%background ns2
 x = 200
 shared = "from_ns2"
 """)
     
-    # Wait for background processes to complete
-    time.sleep(2)
-    
     # Variables should not be in global namespace
     assert 'x' not in ip.user_ns
     assert 'shared' not in ip.user_ns
     
     # Check namespace variables by running code in each namespace
-    # that accesses the variables
+    # that accesses the variables; results stay in the namespace too
+    namespaces = ip._background_magic_instance._namespaces
     
     # Check ns1 variables
-    result1 = ip.run_cell("""%%background ns1
+    result1 = run_background("""%%background ns1
 print(f"x = {x}, shared = {shared}")
 result = (x, shared)
 """)
-    
-    time.sleep(1)
-    assert ip.user_ns.get('result') == (100, "from_ns1")
+    assert namespaces['ns1'].get('result') == (100, "from_ns1")
     
     # Check ns2 variables
-    result2 = ip.run_cell("""%%background ns2
+    result2 = run_background("""%%background ns2
 print(f"x = {x}, shared = {shared}")
 result = (x, shared)
 """)
-    
-    time.sleep(1)
-    assert ip.user_ns.get('result') == (200, "from_ns2")
+    assert namespaces['ns2'].get('result') == (200, "from_ns2")
+    assert 'result' not in ip.user_ns
+
 
-def test_namespace_variable_persistence(ip):
+def test_namespace_variable_persistence(ip, run_background):
     """Test if variables persist between cells in the same namespace."""
     # First cell in namespace
-    ip.run_cell("""%%background persistent
+    run_background("""%%background persistent
 step1 = True
 data = [1, 2, 3]
 """)
     
-    time.sleep(1)
-    
     # Second cell in same namespace should have access to previous variables
-    ip.run_cell("""%%background persistent
+    run_background("""%%background persistent
 assert step1 == True
 data.append(4)
 result = data
 """)
     
-    time.sleep(1)
-    
     # Third cell verifies persistence
-    ip.run_cell("""%%background persistent
+    run_background("""%%background persistent
 assert data == [1, 2, 3, 4]
 final_result = len(data)
 """)
     
-    time.sleep(1)
-    
-    # Check final result
-    assert ip.user_ns.get('final_result') == 4
+    # Check final result, which lands in the namespace rather than the globals
+    namespaces = ip._background_magic_instance._namespaces
+    assert namespaces['persistent'].get('final_result') == 4
+    assert 'final_result' not in ip.user_ns
+
 
-def test_unpicklable_object_handling(ip):
+def test_unpicklable_object_handling(ip, run_background):
     """Test handling of unpicklable objects."""
     # Capture stderr to check for warning messages
     stderr_capture = io.StringIO()
     with redirect_stderr(stderr_capture):
         # Run code that creates both picklable and unpicklable objects
-        ip.run_cell("""%%background
+        run_background("""%%background
 # Picklable variables
 normal_var = 123
 normal_list = [1, 2, 3]
@@ -133,33 +119,29 @@ def unpicklable_function():
 
 func_var = unpicklable_function
 """)
-        
-        # Wait for background process to complete
-        time.sleep(2)
     
-    # Check stderr for warning about skipped variables
+    # Check stderr for warning about skipped variables: the bare module import
     stderr_content = stderr_capture.getvalue()
-    assert "Skipped non-serializable variables" in stderr_content
+    assert "Skipped non-transferable variables: sys" in stderr_content
     
     # Picklable variables should be transferred
     assert ip.user_ns.get('normal_var') == 123
     assert ip.user_ns.get('normal_list') == [1, 2, 3]
     
-    # Unpicklable variables should be skipped
-    # Either they're not in user_ns or they're None
-    if 'module_var' in ip.user_ns:
-        assert ip.user_ns.get('module_var') is not sys
-    if 'func_var' in ip.user_ns:
-        assert not callable(ip.user_ns.get('func_var'))
-
-def test_variable_modification_tracking(ip):
+    # Explicit assignments still pickle: the module by reference, the function by value
+    assert ip.user_ns.get('module_var') is sys
+    assert callable(ip.user_ns.get('func_var'))
+    assert ip.user_ns['func_var']() is sys.stdout
+
+
+def test_variable_modification_tracking(ip, run_background):
     """Test that only variables created or modified in the cell are returned."""
     # Set up initial variables
     ip.run_cell("initial_var = 'unchanged'")
     ip.run_cell("to_be_modified = 'original'")
     
     # Run background cell that creates new variables and modifies existing ones
-    ip.run_cell("""%%background
+    run_background("""%%background
 # Create new variable
 new_var = 'new value'
 
@@ -170,11 +152,120 @@ to_be_modified = 'modified'
 print(f"Initial var: {initial_var}")
 """)
     
-    # Wait for background process to complete
-    time.sleep(2)
-    
     # Check variables
     assert 'new_var' in ip.user_ns
     assert ip.user_ns.get('new_var') == 'new value'
     assert ip.user_ns.get('to_be_modified') == 'modified'
-    assert ip.user_ns.get('initial_var') == 'unchanged' 
\ No newline at end of file
+    assert ip.user_ns.get('initial_var') == 'unchanged'
+
+
+def test_worker_is_reused_with_fresh_globals(ip, run_background):
+    """Test that consecutive cells share a warm worker but still see the current globals."""
+    ip.run_cell("shared = [1, 2, 3]")
+    ip.run_cell("import numpy as np\nunchanged = np.arange(100000)")
+    run_background("""%%background
+import os
+first_pid = os.getpid()
+shared.append(4)
+""")
+    assert ip.user_ns.get('shared') == [1, 2, 3, 4]
+
+    # Rebind a global between runs; the worker must pick up the new value
+    ip.run_cell("shared = ['rebound']")
+    run_background("""%%background
+import os
+second_pid = os.getpid()
+seen = list(shared)
+total = int(unchanged.sum())
+""")
+    assert ip.user_ns.get('second_pid') == ip.user_ns.get('first_pid')
+    assert ip.user_ns.get('seen') == ['rebound']
+    assert ip.user_ns.get('total') == 4999950000
+
+
+class _RebuiltBare:
+    """Pickles without its attributes, so a cell can tell an unpickled copy from the original."""
+
+    def __init__(self):
+        self.origin = 'kernel'
+
+    def __reduce__(self):
+        return (_RebuiltBare.__new__, (_RebuiltBare,))
+
+
+@pytest.mark.skipif(__import__('multiprocessing').get_start_method() != 'fork', reason="needs the fork start method")
+def test_new_worker_runs_on_inherited_globals(ip, run_background):
+    """Test that a freshly forked worker uses the kernel's globals as they are, and a warm one copies."""
+    ip.user_ns['tracked'] = _RebuiltBare()
+    run_background("%%background\nfound = getattr(tracked, 'origin', 'copy')")
+    assert ip.user_ns.get('found') == 'kernel'
+    # The first run also filled the worker's cache: the next one unpickles
+    ip.user_ns['tracked'] = _RebuiltBare()
+    run_background("%%background\nfound = getattr(tracked, 'origin', 'copy')")
+    assert ip.user_ns.get('found') == 'copy'
+
+
+def test_unpicklable_global_is_missing_on_fresh_and_warm_workers(ip, run_background):
+    """A global that cannot be pickled is dropped whichever worker the cell lands on."""
+    import sqlite3
+    ip.user_ns['conn'] = sqlite3.connect(':memory:')
+    for _ in range(2):
+        run_background("%%background\nfound = 'conn' in globals()")
+        assert ip.user_ns.get('found') is False
+    ip.user_ns.pop('conn').close()
+
+
+def test_background_returns_handle_to_wait_on(ip):
+    """Test that the magic returns at once with a handle that waits for the variables."""
+    start = time.time()
+    handle = ip.run_cell("""%%background
+import time
+time.sleep(0.5)
+res = 41 + 1
+""").result
+    assert time.time() - start < 0.5
+    # Attribute access never blocks, so hasattr() from tooling cannot hang the kernel
+    assert not hasattr(handle, 'res')
+    assert handle['res'] == 42
+    assert handle.done()
+    assert handle.res == 42
+    assert ip.user_ns.get('res') == 42
+
+
+def test_handle_reads_variables_named_like_its_methods(ip, run_background):
+    """Returned names that clash with the handle's methods are read by subscription."""
+    handle = run_background("%%background\ndone = 'value'\nwait = 1")
+    assert handle['done'] == 'value' and handle['wait'] == 1
+    assert handle.done() is True
+    assert handle.get('missing', 'default', timeout=0) == 'default'
+    with pytest.raises(KeyError, match="did not return 'missing'"):
+        handle['missing']
+
+
+def test_handle_get_times_out_while_running(ip):
+    """Test that get() gives up with TimeoutError once its timeout passes while the task runs."""
+    handle = ip.run_cell("%%background\nimport time\ntime.sleep(30)\nres = 1").result
+    with pytest.raises(TimeoutError):
+        handle.get('res', timeout=0.05)
+    ip._background_magic_instance._stop_task(handle.task_id)
+
+
+def test_assigned_names_cover_multiline_and_unpacking():
+    """Assignment detection follows the cell's syntax, not its line layout."""
+    from background_magic.background_runner import _assigned_names
+
+    code = """
+a, (b, *rest) = 1, (2, 3, 4)
+total += 1
+label: str = 'x'
+frame = dict(
+    k=1)
+for i, j in pairs:
+    pass
+if (n := len(rest)):
+    items.append(n)
+if a == b:
+    pass
+"""
+    assert _assigned_names(code) == {'a', 'b', 'rest', 'total', 'label', 'frame', 'i', 'j', 'n', 'items'}
+    assert _assigned_names('if x ==') == frozenset()